@@ -0,0 +1,48 @@
+"""Page rasterization and image normalization for the media worker processes.
+
+Kept apart from server.py so the worker pool only imports this module (and
+fitz / PIL when first used), not the app with its database client, LLM
+backend and executors.
+"""
+import os
+from pathlib import Path
+
+
+def pdf_page_count(file_path: str) -> int:
+    import fitz
+    
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+def render_pdf_page(file_path: str, page_number: int, dpi: int) -> str:
+    import fitz
+    
+    source = Path(file_path)
+    output = source.with_name(f"{source.stem}.page{page_number + 1}-{dpi}dpi.png")
+    if not output.exists():
+        with fitz.open(file_path) as doc:
+            pixmap = doc.load_page(page_number).get_pixmap(dpi=dpi)
+            partial = output.with_name(output.name + ".part")
+            pixmap.save(str(partial), output="png")
+            os.replace(partial, output)
+    return str(output)
+
+def normalize_image(file_path: str, max_edge: int, quality: int) -> str:
+    """Apply EXIF orientation, cap the longest edge and re-encode as JPEG"""
+    from PIL import Image, ImageOps
+    
+    if max_edge <= 0:
+        return file_path
+    source = Path(file_path)
+    output = source.with_name(f"{source.stem}.norm{max_edge}-q{quality}.jpg")
+    if not output.exists():
+        with Image.open(file_path) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            partial = output.with_name(output.name + ".part")
+            image.convert("RGB").save(partial, format="JPEG", quality=quality, optimize=True)
+            os.replace(partial, output)
+    return str(output)
+
+def prepare_pdf_page(file_path: str, page_number: int, dpi: int, max_edge: int, quality: int) -> str:
+    return normalize_image(render_pdf_page(file_path, page_number, dpi), max_edge, quality)
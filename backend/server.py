@@ -1,30 +1,78 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Header
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse, StreamingResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, ASCENDING, DESCENDING, CursorType
+from bson import ObjectId
+from pymongo.errors import CollectionInvalid, DuplicateKeyError
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from cachetools import TTLCache
+from python_multipart import MultipartParser
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import parse_options_header
 import os
+import time
+import random
+import asyncio
 import logging
+import abc
+import math
+import multiprocessing
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 import base64
 import json
+import orjson
+import csv
+import zipfile
+import copy
+import re
+import hashlib
+import mimetypes
 import aiofiles
 import google.generativeai as genai
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionRequest
 
+import media
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'menu_management')]
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', '100')),
+    minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+    maxIdleTimeMS=int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', '0')) or None,
+    connectTimeoutMS=int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '20000')),
+    serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000')),
+    socketTimeoutMS=int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', '0')) or None,
+    waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '0')) or None
+)
+DB_NAME = os.environ.get('DB_NAME', 'menu_management')
+db = client[DB_NAME]
+
+# Read preferences for heavy read routes ("primary", "primaryPreferred",
+# "secondary", "secondaryPreferred" or "nearest"); writes always go to the primary
+ANALYTICS_READ_PREFERENCE = os.environ.get('ANALYTICS_READ_PREFERENCE', 'primary')
+EXPORT_READ_PREFERENCE = os.environ.get('EXPORT_READ_PREFERENCE', 'primary')
+LISTING_READ_PREFERENCE = os.environ.get('LISTING_READ_PREFERENCE', 'primary')
+# Secondaries further behind than this are not read from (-1 disables, minimum 90)
+READ_MAX_STALENESS_SECONDS = int(os.environ.get('READ_MAX_STALENESS_SECONDS', '90'))
+# Price history snapshots are stored as deltas, with a full keyframe every N per menu
+PRICE_HISTORY_KEYFRAME_INTERVAL = int(os.environ.get('PRICE_HISTORY_KEYFRAME_INTERVAL', '20'))
+# After a user writes, their routed reads use the primary for this long
+READ_YOUR_WRITES_SECONDS = int(os.environ.get('READ_YOUR_WRITES_SECONDS', '120'))
 
 # JWT settings
 JWT_SECRET = os.environ.get('JWT_SECRET', 'menu-genius-secret-key-2024')
@@ -38,8 +86,54 @@ STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', '')
 # Configure Gemini
 genai.configure(api_key=GEMINI_API_KEY)
 
+# LLM backend: "gemini", or "fake" to replay recorded responses (load testing)
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+LLM_RECORD_PATH = os.environ.get('LLM_RECORD_PATH', '')
+LLM_FAKE_RECORDINGS = os.environ.get('LLM_FAKE_RECORDINGS', '')
+LLM_FAKE_LATENCY_MS = float(os.environ.get('LLM_FAKE_LATENCY_MS', '1500'))
+LLM_FAKE_JITTER_MS = float(os.environ.get('LLM_FAKE_JITTER_MS', '500'))
+LLM_FAKE_ERROR_RATE = float(os.environ.get('LLM_FAKE_ERROR_RATE', '0'))
+LLM_FAKE_TRUNCATE_RATE = float(os.environ.get('LLM_FAKE_TRUNCATE_RATE', '0'))
+
+# Analysis worker pool
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', '2'))
+ANALYSIS_POLL_INTERVAL = float(os.environ.get('ANALYSIS_POLL_INTERVAL', '5'))
+ANALYSIS_LEASE_SECONDS = int(os.environ.get('ANALYSIS_LEASE_SECONDS', '300'))
+# Page-level fan-out: per job, and across every job on this process
+ANALYSIS_PAGE_CONCURRENCY = int(os.environ.get('ANALYSIS_PAGE_CONCURRENCY', '4'))
+ANALYSIS_GLOBAL_PAGE_CONCURRENCY = int(os.environ.get('ANALYSIS_GLOBAL_PAGE_CONCURRENCY', '8'))
+# Threads for blocking Gemini calls and file hashing; defaults to one per global page slot
+LLM_THREADS = int(os.environ.get('LLM_THREADS', str(ANALYSIS_GLOBAL_PAGE_CONCURRENCY)))
+EVENT_LOOP_LAG_INTERVAL = float(os.environ.get('EVENT_LOOP_LAG_INTERVAL', '0.5'))
+
+# PDF pages are rasterized in a process pool, a few pages ahead of extraction
+MEDIA_PROCESSES = int(os.environ.get('MEDIA_PROCESSES', '2'))
+PDF_RENDER_DPI = int(os.environ.get('PDF_RENDER_DPI', '150'))
+PDF_RENDER_LOOKAHEAD = int(os.environ.get('PDF_RENDER_LOOKAHEAD', '2'))
+# Page images are re-encoded to this max edge before going to the LLM (0 disables)
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '2048'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+
+# Page extraction cache (entries expire after this long without a hit)
+EXTRACTION_CACHE_TTL_SECONDS = int(os.environ.get('EXTRACTION_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.environ.get('EXTRACTION_CACHE_MAX_ENTRIES', '50000'))
+
+# Password hashing runs on its own small pool so login bursts can't starve the event loop
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_THREADS = int(os.environ.get('PASSWORD_HASH_THREADS', '2'))
+
+# Export compression runs on its own pool so large archives can't stall the event loop
+EXPORT_THREADS = int(os.environ.get('EXPORT_THREADS', '2'))
+
+# Authenticated users are cached per process; changes are broadcast to other
+# workers through a capped collection, and the TTL bounds staleness if that lags
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', '30'))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))
+USER_INVALIDATION_COLLECTION_BYTES = int(os.environ.get('USER_INVALIDATION_COLLECTION_BYTES', str(1024 * 1024)))
+USER_INVALIDATION_RESUME_OVERLAP_SECONDS = float(os.environ.get('USER_INVALIDATION_RESUME_OVERLAP_SECONDS', '5'))
+
 # Create the main app
-app = FastAPI(title="MenuGenius API", version="1.0.0")
+app = FastAPI(title="MenuGenius API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -51,9 +145,16 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 # Upload directory
-UPLOAD_DIR = ROOT_DIR / "uploads"
+UPLOAD_DIR = Path(os.environ.get('UPLOAD_DIR', str(ROOT_DIR / "uploads")))
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Upload limits (bytes)
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))
+MAX_UPLOAD_FILE_BYTES = int(os.environ.get('MAX_UPLOAD_FILE_BYTES', str(25 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.environ.get('MAX_UPLOAD_REQUEST_BYTES', str(100 * 1024 * 1024)))
+MAX_UPLOAD_FIELD_BYTES = int(os.environ.get('MAX_UPLOAD_FIELD_BYTES', str(4 * 1024)))
+MIN_UPLOAD_FILE_BYTES = int(os.environ.get('MIN_UPLOAD_FILE_BYTES', '64'))  # Smaller than any real PDF or image
+
 # ============== MODELS ==============
 
 class UserCreate(BaseModel):
@@ -162,12 +263,29 @@ SUBSCRIPTION_PLANS = {
 
 # ============== AUTH HELPERS ==============
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_THREADS, thread_name_prefix="bcrypt")
+
+def _hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
-def verify_password(password: str, hashed: str) -> bool:
+def _verify_password_sync(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, _hash_password_sync, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, _verify_password_sync, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a stored hash was made with a different work factor than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
 def create_token(user_id: str) -> str:
     payload = {
         "user_id": user_id,
@@ -175,19 +293,85 @@ def create_token(user_id: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl=USER_CACHE_TTL_SECONDS)
+PROCESS_ID = uuid.uuid4().hex
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id = payload.get("user_id")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.users.find_one({"id": user_id}, {"_id": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache[user_id] = user
+            metrics_counters["user_cache_misses"] += 1
+        else:
+            metrics_counters["user_cache_hits"] += 1
+        # Routes may modify what they get; the cached copy must stay intact
+        return copy.deepcopy(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+async def invalidate_user(user_id: str):
+    """Drop a user from this process's cache and tell the other workers to do the same"""
+    user_cache.pop(user_id, None)
+    try:
+        await db.user_invalidations.insert_one({
+            "user_id": user_id,
+            "origin": PROCESS_ID,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+    except Exception as e:
+        logger.error(f"Failed to broadcast invalidation for user {user_id}: {str(e)}")
+
+async def ensure_user_invalidation_channel():
+    """Create the capped invalidation channel; runs at startup, before anything can insert into it"""
+    try:
+        await db.create_collection("user_invalidations", capped=True, size=USER_INVALIDATION_COLLECTION_BYTES)
+    except CollectionInvalid:
+        pass
+    # An insert that beat the create leaves an ordinary collection, which cannot be tailed
+    options = await db.user_invalidations.options()
+    if not options.get("capped"):
+        logger.warning("user_invalidations is not capped; converting it")
+        await db.command("convertToCapped", "user_invalidations", size=USER_INVALIDATION_COLLECTION_BYTES)
+    # A tailable cursor on an empty capped collection dies immediately
+    if await db.user_invalidations.find_one({}, {"_id": 1}) is None:
+        await db.user_invalidations.insert_one({"user_id": None, "origin": PROCESS_ID})
+
+async def user_invalidation_listener():
+    """Tail the invalidation channel and evict users changed by other workers"""
+    while True:
+        try:
+            await ensure_user_invalidation_channel()
+            latest = await db.user_invalidations.find_one({}, {"_id": 1}, sort=[("$natural", -1)])
+            # Resume from the newest event's timestamp rather than the event
+            # itself, which may roll out of the capped collection before the
+            # cursor reaches it. ObjectIds from different workers are only
+            # ordered to the second, so the overlap replays a few recent
+            # events; evicting a user twice is harmless.
+            query = {}
+            if latest is not None:
+                resume_at = latest["_id"].generation_time - timedelta(seconds=USER_INVALIDATION_RESUME_OVERLAP_SECONDS)
+                query = {"_id": {"$gt": ObjectId.from_datetime(resume_at)}}
+            cursor = db.user_invalidations.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            # Anything missed while (re)connecting may be stale
+            user_cache.clear()
+            while cursor.alive:
+                async for event in cursor:
+                    if event.get("origin") != PROCESS_ID and event.get("user_id"):
+                        user_cache.pop(event["user_id"], None)
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"User invalidation listener error: {str(e)}")
+        await asyncio.sleep(ANALYSIS_POLL_INTERVAL)
+
 # ============== AUTH ROUTES ==============
 
 # Admin credentials
@@ -205,7 +389,7 @@ async def admin_login():
         admin = {
             "id": admin_id,
             "email": ADMIN_EMAIL,
-            "password": hash_password(ADMIN_PASSWORD),
+            "password": await hash_password(ADMIN_PASSWORD),
             "name": "Admin",
             "business_name": "MenuGenius Admin",
             "location": "Headquarters",
@@ -237,7 +421,7 @@ async def register(user_data: UserCreate):
     user = {
         "id": user_id,
         "email": user_data.email,
-        "password": hash_password(user_data.password),
+        "password": await hash_password(user_data.password),
         "name": user_data.name,
         "business_name": user_data.business_name,
         "location": user_data.location,
@@ -261,9 +445,17 @@ async def register(user_data: UserCreate):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
     user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password"]):
+    if not user or not await verify_password(credentials.password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade the stored hash to the current work factor while we have the password
+    if password_needs_rehash(user["password"]):
+        await db.users.update_one(
+            {"id": user["id"], "password": user["password"]},
+            {"$set": {"password": await hash_password(credentials.password)}}
+        )
+        await invalidate_user(user["id"])
+    
     token = create_token(user["id"])
     user_response = UserResponse(
         id=user["id"],
@@ -288,122 +480,303 @@ async def get_me(user: dict = Depends(get_current_user)):
         created_at=user["created_at"]
     )
 
-# ============== MENU ROUTES ==============
+# ============== READ ROUTING ==============
 
-@api_router.post("/menus/upload")
-async def upload_menu(
-    files: List[UploadFile] = File(...),
-    name: str = "Uploaded Menu",
-    location: Optional[str] = None,
-    user: dict = Depends(get_current_user)
-):
-    """Upload one or more menu files (images or PDFs) for analysis"""
-    # Check credits
-    if user.get("credits", 0) < 1:
-        raise HTTPException(status_code=402, detail="Insufficient credits. Please purchase more credits.")
-    
-    if not files or len(files) == 0:
-        raise HTTPException(status_code=400, detail="No files provided")
-    
-    file_paths = []
-    
-    for file in files:
-        # Save each uploaded file
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in ['.pdf', '.png', '.jpg', '.jpeg', '.webp']:
-            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.filename}. Please upload PDF or image files.")
-        
-        file_id = str(uuid.uuid4())
-        file_path = UPLOAD_DIR / f"{file_id}{file_ext}"
-        
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-        
-        file_paths.append(str(file_path))
-        logger.info(f"Saved file: {file.filename} -> {file_path}")
-    
-    # Create menu job
-    job_id = str(uuid.uuid4())
-    job = {
-        "id": job_id,
-        "user_id": user["id"],
-        "name": name,
-        "status": "pending",
-        "file_path": file_paths[0] if file_paths else None,  # Legacy support
-        "file_paths": file_paths,  # All uploaded files
-        "items": [],
-        "location": location or user.get("location"),
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "updated_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.menu_jobs.insert_one(job)
-    
-    # Deduct credit
-    await db.users.update_one({"id": user["id"]}, {"$inc": {"credits": -1}})
-    
-    logger.info(f"Created job {job_id} with {len(file_paths)} file(s)")
-    return {"job_id": job_id, "message": f"Menu uploaded successfully ({len(file_paths)} page(s)). Analysis will begin shortly.", "total_pages": len(file_paths)}
+READ_PREFERENCE_MODES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
 
-@api_router.post("/menus/{job_id}/add-page")
-async def add_menu_page(
-    job_id: str,
-    file: UploadFile = File(...),
-    user: dict = Depends(get_current_user)
-):
-    """Add additional pages to an existing menu job"""
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
-    if not job:
-        raise HTTPException(status_code=404, detail="Menu job not found")
-    
-    # Save uploaded file
-    file_ext = Path(file.filename).suffix.lower()
-    if file_ext not in ['.pdf', '.png', '.jpg', '.jpeg', '.webp']:
-        raise HTTPException(status_code=400, detail="Unsupported file type.")
-    
-    file_id = str(uuid.uuid4())
-    file_path = UPLOAD_DIR / f"{file_id}{file_ext}"
-    
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
-    
-    # Add to file_paths list
-    file_paths = job.get("file_paths", [job.get("file_path")])
-    file_paths.append(str(file_path))
-    
-    await db.menu_jobs.update_one(
-        {"id": job_id},
-        {"$set": {"file_paths": file_paths, "updated_at": datetime.now(timezone.utc).isoformat()}}
+def read_preference(mode: str):
+    if mode == "primary":
+        return Primary()
+    if mode not in READ_PREFERENCE_MODES:
+        raise ValueError(f"Unknown read preference: {mode}")
+    return READ_PREFERENCE_MODES[mode](max_staleness=READ_MAX_STALENESS_SECONDS)
+
+# Database handles per route class; they share the client's connection pool
+read_dbs = {
+    "analytics": client.get_database(DB_NAME, read_preference=read_preference(ANALYTICS_READ_PREFERENCE)),
+    "export": client.get_database(DB_NAME, read_preference=read_preference(EXPORT_READ_PREFERENCE)),
+    "listing": client.get_database(DB_NAME, read_preference=read_preference(LISTING_READ_PREFERENCE))
+}
+
+def read_db(route_class: str, user: dict):
+    """Database to read from for a route class; the primary while the user's own writes may not have replicated"""
+    if user.get("read_primary_until", "") > datetime.now(timezone.utc).isoformat():
+        return db
+    return read_dbs[route_class]
+
+# Pinning only matters when some route class may read from a secondary
+READ_ROUTING_ENABLED = any(
+    mode != "primary" for mode in (ANALYTICS_READ_PREFERENCE, EXPORT_READ_PREFERENCE, LISTING_READ_PREFERENCE)
+)
+
+async def mark_recent_write(user: dict):
+    """Pin the user's routed reads to the primary for READ_YOUR_WRITES_SECONDS.
+    
+    A no-op when every route class reads the primary anyway. An existing pin
+    is only extended once less than half of it is left, so a burst of writes
+    costs one user update and one cache eviction rather than one per write.
+    """
+    if not READ_ROUTING_ENABLED:
+        return
+    now = datetime.now(timezone.utc)
+    if user.get("read_primary_until", "") > (now + timedelta(seconds=READ_YOUR_WRITES_SECONDS / 2)).isoformat():
+        return
+    until = (now + timedelta(seconds=READ_YOUR_WRITES_SECONDS)).isoformat()
+    await db.users.update_one({"id": user["id"]}, {"$set": {"read_primary_until": until}})
+    user["read_primary_until"] = until
+    await invalidate_user(user["id"])
+
+# ============== CREDITS ==============
+
+async def record_credit_change(user_id: str, delta: int, reason: str, ref_id: Optional[str], balance_after: Optional[int]):
+    """Append an entry to the credit ledger (never updated or deleted)"""
+    await db.credit_ledger.insert_one({
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "delta": delta,
+        "reason": reason,
+        "ref_id": ref_id,
+        "balance_after": balance_after,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
+
+async def reserve_credit(user_id: str, reason: str, ref_id: str) -> int:
+    """Atomically take one credit if the balance allows it; returns the new balance"""
+    user = await db.users.find_one_and_update(
+        {"id": user_id, "credits": {"$gte": 1}},
+        {"$inc": {"credits": -1}},
+        projection={"_id": 0, "credits": 1},
+        return_document=ReturnDocument.AFTER
     )
-    
-    return {"message": f"Page added. Total pages: {len(file_paths)}", "total_pages": len(file_paths)}
+    if not user:
+        raise HTTPException(status_code=402, detail="Insufficient credits. Please purchase more credits.")
+    try:
+        await invalidate_user(user_id)
+        await record_credit_change(user_id, -1, reason, ref_id, user["credits"])
+    except BaseException:
+        # The debit never reached the ledger, so put the credit straight back
+        await db.users.update_one({"id": user_id}, {"$inc": {"credits": 1}})
+        user_cache.pop(user_id, None)
+        raise
+    return user["credits"]
+
+async def refund_credit(user_id: str, reason: str, ref_id: str):
+    """Return a reserved credit after the operation it paid for failed"""
+    try:
+        await grant_credits(user_id, 1, f"refund:{reason}", ref_id)
+    except Exception as e:
+        logger.error(f"Failed to refund credit for user {user_id} ({reason} {ref_id}): {str(e)}")
+
+async def grant_credits(user_id: str, amount: int, reason: str, ref_id: Optional[str], set_fields: Optional[dict] = None) -> Optional[int]:
+    """Add credits (plus any other user fields) in one write and record it in the ledger"""
+    update = {"$inc": {"credits": amount}}
+    if set_fields:
+        update["$set"] = set_fields
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        update,
+        projection={"_id": 0, "credits": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    await invalidate_user(user_id)
+    await record_credit_change(user_id, amount, reason, ref_id, user["credits"] if user else None)
+    return user["credits"] if user else None
+
+async def complete_transaction(session_id: str, payment_status: str) -> bool:
+    """Mark a payment completed; only the first caller gets True and grants the credits"""
+    result = await db.payment_transactions.update_one(
+        {"session_id": session_id, "status": {"$ne": "completed"}},
+        {"$set": {"status": "completed", "payment_status": payment_status}}
+    )
+    return result.modified_count == 1
 
-@api_router.post("/menus/{job_id}/analyze")
-async def analyze_menu(job_id: str, user: dict = Depends(get_current_user)):
-    import asyncio
-    import PIL.Image
-    
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
-    if not job:
-        raise HTTPException(status_code=404, detail="Menu job not found")
-    
-    if job["status"] not in ["pending", "completed"]:
-        raise HTTPException(status_code=400, detail=f"Cannot analyze menu in {job['status']} status")
+# ============== UPLOADS ==============
+
+# Leading bytes each accepted extension must start with
+UPLOAD_SIGNATURES = {
+    ".pdf": [b"%PDF-"],
+    ".png": [b"\x89PNG\r\n\x1a\n"],
+    ".jpg": [b"\xff\xd8\xff"],
+    ".jpeg": [b"\xff\xd8\xff"],
+    ".webp": [b"RIFF"],
+}
+
+def format_bytes(size: int) -> str:
+    """Human-readable byte count for limits in error messages"""
+    for unit, scale in (("MB", 1024 * 1024), ("KB", 1024)):
+        if size >= scale:
+            return f"{round(size / scale, 1):g} {unit}"
+    return f"{size} bytes"
+
+def matches_signature(head: bytes, file_ext: str) -> bool:
+    if file_ext == ".webp" and head[8:12] != b"WEBP":
+        return False
+    return any(head.startswith(sig) for sig in UPLOAD_SIGNATURES[file_ext])
+
+class UploadPart:
+    """One file part of a multipart body, written to disk as its bytes arrive"""
+    
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file_ext = Path(filename).suffix.lower()
+        if self.file_ext not in UPLOAD_SIGNATURES:
+            raise HTTPException(status_code=400, detail=f"Unsupported file type: {filename}. Please upload PDF or image files.")
+        self.path = UPLOAD_DIR / f"{uuid.uuid4()}{self.file_ext}"
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = bytearray()  # Held back until there are enough bytes to check the signature
+        self.handle = None
+    
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > MAX_UPLOAD_FILE_BYTES:
+            raise HTTPException(status_code=413, detail=f"{self.filename} exceeds the {format_bytes(MAX_UPLOAD_FILE_BYTES)} upload limit.")
+        self.digest.update(chunk)
+        if self.handle is None:
+            self.head.extend(chunk)
+            if len(self.head) < 12:
+                return
+            await self.open()
+        else:
+            await self.handle.write(chunk)
+    
+    async def open(self):
+        if not matches_signature(bytes(self.head), self.file_ext):
+            raise HTTPException(status_code=400, detail=f"{self.filename} is not a valid {self.file_ext[1:].upper()} file.")
+        self.handle = await aiofiles.open(self.path, 'wb')
+        await self.handle.write(bytes(self.head))
+        self.head.clear()
+    
+    async def finish(self) -> Dict[str, Any]:
+        if self.size == 0:
+            raise HTTPException(status_code=400, detail=f"{self.filename} is empty.")
+        if self.size < MIN_UPLOAD_FILE_BYTES:
+            raise HTTPException(status_code=400, detail=f"{self.filename} is too small to be a valid {self.file_ext[1:].upper()} file.")
+        if self.handle is None:
+            await self.open()
+        await self.close()
+        logger.info(f"Saved file: {self.filename} -> {self.path} ({self.size} bytes)")
+        return {"path": str(self.path), "sha256": self.digest.hexdigest(), "size": self.size, "filename": self.filename}
+    
+    async def close(self):
+        if self.handle is not None:
+            await self.handle.close()
+            self.handle = None
+
+async def receive_uploads(request: Request, file_field: str, max_files: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """Parse a multipart body straight off the socket, saving file parts as they arrive.
+    
+    Call this after authentication: the extension, magic-byte and size checks
+    run on the incoming bytes, so a bad file is refused after its first chunk
+    and the request limit holds even for chunked bodies with no Content-Length.
+    Returns the saved uploads and any plain form fields.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the {format_bytes(MAX_UPLOAD_REQUEST_BYTES)} request limit")
+    
+    # The parser's callbacks are synchronous, so they queue events that are
+    # applied (with async disk writes) after each chunk is fed in
+    events: List[Tuple[str, Any]] = []
+    header_field = bytearray()
+    header_value = bytearray()
+    headers: Dict[bytes, bytes] = {}
+    finished = False
+    
+    def on_header_end():
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+    
+    def on_headers_finished():
+        events.append(("part", dict(headers)))
+        headers.clear()
+    
+    def on_end():
+        nonlocal finished
+        finished = True
+    
+    parser = MultipartParser(params[b"boundary"], {
+        "on_header_field": lambda data, start, end: header_field.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: header_value.extend(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": lambda data, start, end: events.append(("data", bytes(data[start:end]))),
+        "on_part_end": lambda: events.append(("end", None)),
+        "on_end": on_end,
+    })
     
-    await db.menu_jobs.update_one({"id": job_id}, {"$set": {"status": "analyzing"}})
+    uploads: List[Dict[str, Any]] = []
+    fields: Dict[str, str] = {}
+    part: Optional[UploadPart] = None
+    field_name: Optional[str] = None
+    field_value = bytearray()
+    received = 0
     
     try:
-        # Get all file paths (support multi-page)
-        file_paths = job.get("file_paths", [job.get("file_path")])
-        
-        all_items = []
-        max_retries = 3
-        
-        # Use Gemini 2.0 Flash for image analysis (fast and cost-effective)
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_REQUEST_BYTES:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds the {format_bytes(MAX_UPLOAD_REQUEST_BYTES)} request limit")
+            try:
+                parser.write(chunk)
+            except MultipartParseError:
+                raise HTTPException(status_code=400, detail="Malformed multipart upload")
+            
+            for kind, value in events:
+                if kind == "part":
+                    _, options = parse_options_header(value.get(b"content-disposition", b""))
+                    name = options.get(b"name", b"").decode("utf-8", "replace")
+                    filename = options.get(b"filename")
+                    part, field_name = None, None
+                    if filename is not None:
+                        if name != file_field:
+                            raise HTTPException(status_code=400, detail=f"Unexpected file field: {name}")
+                        if max_files is not None and len(uploads) >= max_files:
+                            raise HTTPException(status_code=400, detail=f"At most {max_files} file(s) allowed")
+                        part = UploadPart(filename.decode("utf-8", "replace"))
+                    else:
+                        field_name = name
+                        field_value.clear()
+                elif kind == "data":
+                    if part is not None:
+                        await part.write(value)
+                    elif field_name is not None:
+                        field_value.extend(value)
+                        if len(field_value) > MAX_UPLOAD_FIELD_BYTES:
+                            raise HTTPException(status_code=400, detail=f"Form field {field_name} is too long")
+                elif kind == "end":
+                    if part is not None:
+                        uploads.append(await part.finish())
+                    elif field_name is not None:
+                        fields[field_name] = field_value.decode("utf-8", "replace")
+                    part, field_name = None, None
+            events.clear()
         
-        system_prompt = """You are a restaurant menu analysis expert. Extract ALL menu items with details.
+        if not finished:
+            raise HTTPException(status_code=400, detail="Upload ended before the multipart body was complete")
+    except BaseException:
+        if part is not None:
+            await part.close()
+            part.path.unlink(missing_ok=True)
+        for upload in uploads:
+            Path(upload["path"]).unlink(missing_ok=True)
+        raise
+    
+    return uploads, fields
+
+# ============== MENU ANALYSIS ==============
+
+MENU_EXTRACTION_PROMPT = """You are a restaurant menu analysis expert. Extract ALL menu items with details.
 
 For each item provide:
 1. Item name (exactly as on menu)
@@ -426,127 +799,1027 @@ Return ONLY valid JSON (no markdown, no explanation):
 }
 
 CRITICAL: Extract ALL items. Do not skip any."""
+
+EXTRACTION_MODEL = 'gemini-2.0-flash'
+
+# Response schema for structured (JSON mode) extraction output
+MENU_ITEMS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "description": {"type": "string"},
+                    "current_price": {"type": "number"},
+                    "ingredients": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "name": {"type": "string"},
+                                "portion": {"type": "string"},
+                                "estimated_cost": {"type": "number"}
+                            },
+                            "required": ["name", "estimated_cost"]
+                        }
+                    },
+                    "food_cost": {"type": "number"}
+                },
+                "required": ["name", "current_price"]
+            }
+        }
+    },
+    "required": ["items"]
+}
+
+EXTRACTION_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": MENU_ITEMS_SCHEMA
+}
+
+# Cached extractions are only reused for the same model, prompt and schema
+EXTRACTION_VERSION = hashlib.sha256(
+    f"{EXTRACTION_MODEL}\n{MENU_EXTRACTION_PROMPT}\n{json.dumps(MENU_ITEMS_SCHEMA, sort_keys=True)}".encode()
+).hexdigest()[:16]
+
+# Shared by all jobs on this process so concurrent analyses can't exceed the global limit
+page_extraction_slots = asyncio.Semaphore(ANALYSIS_GLOBAL_PAGE_CONCURRENCY)
+
+# The Gemini SDK and file hashing are blocking; run them here so they never stall the event loop
+llm_executor = ThreadPoolExecutor(max_workers=LLM_THREADS, thread_name_prefix="llm")
+
+def _hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ============== LLM BACKENDS ==============
+
+COMPETITOR_MODEL = 'gemini-2.5-flash'
+
+class LLMResult(BaseModel):
+    text: str
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+
+class LLMBackend(abc.ABC):
+    """The model calls made by the analysis pipeline.
+    
+    `extract_page` sends one normalized page image with the extraction prompt
+    and schema; `generate_json` is a text-only call that returns JSON.
+    """
+    name = "base"
+    
+    @abc.abstractmethod
+    async def extract_page(self, file_path: str, prompt: str) -> LLMResult:
+        ...
+    
+    @abc.abstractmethod
+    async def generate_json(self, system_prompt: str, prompt: str) -> LLMResult:
+        ...
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+    
+    def __init__(self):
+        self.extraction_model = genai.GenerativeModel(EXTRACTION_MODEL)
+    
+    @staticmethod
+    def _result(response) -> LLMResult:
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResult(
+            text=response.text,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0
+        )
+    
+    def _extract_page_sync(self, file_path: str, prompt: str) -> LLMResult:
+        # Send the file bytes as-is; pages are already normalized during ingestion
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        mime_type = mimetypes.guess_type(file_path)[0] or "image/jpeg"
+        response = self.extraction_model.generate_content(
+            [MENU_EXTRACTION_PROMPT, {"mime_type": mime_type, "data": data}, prompt],
+            generation_config=EXTRACTION_GENERATION_CONFIG
+        )
+        return self._result(response)
+    
+    def _generate_json_sync(self, system_prompt: str, prompt: str) -> LLMResult:
+        model = genai.GenerativeModel(COMPETITOR_MODEL, system_instruction=system_prompt)
+        response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+        return self._result(response)
+    
+    # The Gemini SDK is synchronous, so calls run on the bounded llm_executor
+    async def extract_page(self, file_path: str, prompt: str) -> LLMResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(llm_executor, self._extract_page_sync, file_path, prompt)
+    
+    async def generate_json(self, system_prompt: str, prompt: str) -> LLMResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(llm_executor, self._generate_json_sync, system_prompt, prompt)
+
+class RecordingBackend(LLMBackend):
+    """Wraps another backend and appends every response to a JSONL file for FakeLLMBackend"""
+    
+    def __init__(self, inner: LLMBackend, record_path: str):
+        self.inner = inner
+        self.name = f"{inner.name}+recording"
+        self.record_path = record_path
+    
+    async def _record(self, kind: str, result: LLMResult) -> LLMResult:
+        async with aiofiles.open(self.record_path, 'a') as f:
+            await f.write(json.dumps({"kind": kind, **result.model_dump()}) + "\n")
+        return result
+    
+    async def extract_page(self, file_path: str, prompt: str) -> LLMResult:
+        return await self._record("extract", await self.inner.extract_page(file_path, prompt))
+    
+    async def generate_json(self, system_prompt: str, prompt: str) -> LLMResult:
+        return await self._record("json", await self.inner.generate_json(system_prompt, prompt))
+
+class FakeLLMBackend(LLMBackend):
+    """Replays recorded responses with simulated latency, errors and truncation.
+    
+    Recordings are the JSONL written by RecordingBackend; without them a
+    synthetic page of menu items is returned. Latency is simulated with a
+    blocking sleep on llm_executor so thread pool limits behave as with Gemini.
+    """
+    name = "fake"
+    
+    def __init__(self, recordings_path: str = "", latency_ms: float = 0, jitter_ms: float = 0,
+                 error_rate: float = 0, truncate_rate: float = 0):
+        self.recordings = {"extract": [], "json": []}
+        if recordings_path:
+            with open(recordings_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.recordings[record["kind"]].append(LLMResult(**{k: v for k, v in record.items() if k != "kind"}))
+        self.calls = {"extract": 0, "json": 0}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+    
+    @staticmethod
+    def _synthetic(kind: str, prompt: str) -> LLMResult:
+        if kind == "json":
+            names = json.loads(prompt[prompt.index("["):]) if "[" in prompt else []
+            text = json.dumps({
+                "restaurants_analyzed": [{"name": "Fake Bistro", "type": "Casual Dining", "distance_miles": 4.2}],
+                "competitors": [
+                    {"item_name": name, "competitor_prices": [{"restaurant": "Fake Bistro", "price": 12.5, "distance_miles": 4.2}],
+                     "avg_market_price": 12.5, "price_range": {"min": 11.0, "max": 14.0}}
+                    for name in names
+                ]
+            })
+        else:
+            page = uuid.uuid4().hex[:6]
+            text = json.dumps({"items": [
+                {"name": f"Item {page}-{i}", "description": "Synthetic item", "current_price": 9.5 + i,
+                 "ingredients": [{"name": "Ingredient", "portion": "4 oz", "estimated_cost": 1.25}], "food_cost": 3.0 + i / 4}
+                for i in range(12)
+            ]})
+        return LLMResult(text=text, prompt_tokens=len(prompt) // 4 + 258, output_tokens=len(text) // 4)
+    
+    def _respond_sync(self, kind: str, prompt: str) -> LLMResult:
+        time.sleep(max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000)
+        if random.random() < self.error_rate:
+            raise RuntimeError("Injected LLM error")
         
-        for page_idx, file_path in enumerate(file_paths):
-            page_items = []
-            last_error = None
-            
-            for attempt in range(max_retries):
-                try:
-                    logger.info(f"Page {page_idx + 1} attempt {attempt + 1}: Using Gemini 2.0 Flash")
-                    
-                    # Load image
-                    image = PIL.Image.open(file_path)
-                    
-                    # Generate content with image
-                    response = model.generate_content([
-                        system_prompt,
-                        image,
-                        f"Analyze this menu page (page {page_idx + 1} of {len(file_paths)}). Extract EVERY menu item with prices, ingredients, and food costs. Return ONLY JSON."
-                    ])
-                    
-                    # Parse response
-                    response_text = response.text.strip()
-                    
-                    # Clean up response - remove markdown code blocks if present
-                    if response_text.startswith("```"):
-                        lines = response_text.split("\n")
-                        # Remove first line (```json) and last line (```)
-                        lines = [l for l in lines if not l.startswith("```")]
-                        response_text = "\n".join(lines)
-                    
-                    menu_data = json.loads(response_text)
-                    page_items = menu_data.get("items", [])
-                    logger.info(f"Page {page_idx + 1}: Found {len(page_items)} items (attempt {attempt + 1})")
-                    break  # Success, exit retry loop
-                    
-                except json.JSONDecodeError as e:
-                    last_error = f"JSON parse error: {str(e)}"
-                    logger.warning(f"Page {page_idx + 1} attempt {attempt + 1}: {last_error}")
-                except Exception as e:
-                    last_error = str(e)
-                    logger.warning(f"Page {page_idx + 1} attempt {attempt + 1} failed: {last_error}")
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)  # Exponential backoff
-            
-            if page_items:
-                all_items.extend(page_items)
-            elif last_error:
-                logger.error(f"Failed to analyze page {page_idx + 1} after {max_retries} attempts: {last_error}")
+        recorded = self.recordings[kind]
+        if recorded:
+            result = recorded[self.calls[kind] % len(recorded)]
+        else:
+            result = self._synthetic(kind, prompt)
+        self.calls[kind] += 1
         
-        # Process all collected items and add IDs
-        processed_items = []
-        total_food_cost = 0
-        total_profit = 0
+        if random.random() < self.truncate_rate:
+            cut = random.randint(1, max(1, len(result.text) - 1))
+            result = LLMResult(text=result.text[:cut], prompt_tokens=result.prompt_tokens, output_tokens=result.output_tokens)
+        return result
+    
+    async def extract_page(self, file_path: str, prompt: str) -> LLMResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(llm_executor, self._respond_sync, "extract", prompt)
+    
+    async def generate_json(self, system_prompt: str, prompt: str) -> LLMResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(llm_executor, self._respond_sync, "json", prompt)
+
+def create_llm_backend() -> LLMBackend:
+    if LLM_BACKEND == "fake":
+        backend = FakeLLMBackend(
+            recordings_path=LLM_FAKE_RECORDINGS,
+            latency_ms=LLM_FAKE_LATENCY_MS,
+            jitter_ms=LLM_FAKE_JITTER_MS,
+            error_rate=LLM_FAKE_ERROR_RATE,
+            truncate_rate=LLM_FAKE_TRUNCATE_RATE
+        )
+    elif LLM_BACKEND == "gemini":
+        backend = GeminiBackend()
+    else:
+        raise RuntimeError(f"Unknown LLM_BACKEND: {LLM_BACKEND}")
+    
+    if LLM_RECORD_PATH:
+        backend = RecordingBackend(backend, LLM_RECORD_PATH)
+    logger.info(f"Using LLM backend: {backend.name}")
+    return backend
+
+llm_backend = create_llm_backend()
+
+_json_decoder = json.JSONDecoder()
+_ITEMS_ARRAY_START = re.compile(r'"items"\s*:\s*\[')
+_WHITESPACE = re.compile(r'\s*')
+
+def _optional_float(value) -> Optional[float]:
+    return float(value) if value is not None else None
+
+def _is_price(value: Any) -> bool:
+    """Missing (counted as 0) or a finite number, possibly sent as a numeric string"""
+    if isinstance(value, bool):
+        return False
+    try:
+        number = _optional_float(value)
+    except (TypeError, ValueError):
+        return False
+    return number is None or math.isfinite(number)
+
+def _is_menu_item(value: Any) -> bool:
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get("name"), str)
+        and value["name"].strip() != ""
+        and _is_price(value.get("current_price"))
+        and _is_price(value.get("food_cost"))
+    )
+
+def salvage_menu_items(response_text: str) -> Tuple[List[dict], bool]:
+    """Parse an extraction response, keeping every well-formed item.
+    
+    Returns (items, complete). For truncated or malformed output the items
+    array is decoded one element at a time and parsing stops at the first
+    broken element, so `complete` is False and the items before it are kept.
+    """
+    text = response_text.strip()
+    
+    # Clean up response - remove markdown code blocks if present
+    if text.startswith("```"):
+        text = "\n".join(line for line in text.split("\n") if not line.startswith("```"))
+    
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and isinstance(data.get("items"), list):
+            return [item for item in data["items"] if _is_menu_item(item)], True
+    except json.JSONDecodeError:
+        pass
+    
+    match = _ITEMS_ARRAY_START.search(text)
+    if not match:
+        return [], False
+    
+    items = []
+    pos = _WHITESPACE.match(text, match.end()).end()
+    if text.startswith("]", pos):
+        return items, True
+    while True:
+        try:
+            value, pos = _json_decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return items, False
+        if _is_menu_item(value):
+            items.append(value)
+        # Elements must be separated by a comma; anything else is malformed
+        pos = _WHITESPACE.match(text, pos).end()
+        if text.startswith("]", pos):
+            return items, True
+        if not text.startswith(",", pos):
+            return items, False
+        pos = _WHITESPACE.match(text, pos + 1).end()
+
+def record_llm_stat(stats: Dict[str, int], key: str, value: int = 1):
+    """Count towards both the job's analysis_stats and the process-wide metrics"""
+    stats[key] += value
+    metrics_counters[f"llm_{key}"] += value
+
+async def extract_page_items(
+    file_path: str,
+    page_idx: int,
+    total_pages: int,
+    stats: Optional[Dict[str, int]] = None,
+    max_retries: int = 3
+) -> Tuple[Optional[List[dict]], bool]:
+    """Extract raw menu items from a single page.
+    
+    Well-formed items are kept from truncated or malformed responses, and a
+    retry only asks for the items that are still missing. API errors are
+    retried with exponential backoff.
+    
+    Returns (items, complete); items is None if nothing could be extracted.
+    """
+    stats = stats if stats is not None else defaultdict(int)
+    page_prompt = f"Analyze this menu page (page {page_idx + 1} of {total_pages}). Extract EVERY menu item with prices, ingredients, and food costs. Return ONLY JSON."
+    items = []
+    seen_names = set()
+    complete = False
+    last_error = None
+    
+    for attempt in range(max_retries):
+        if attempt > 0:
+            record_llm_stat(stats, "retries")
         
-        # Remove duplicates based on name (case-insensitive)
-        seen_names = set()
-        unique_items = []
-        for item in all_items:
-            name_lower = item.get("name", "").lower().strip()
-            if name_lower and name_lower not in seen_names:
-                seen_names.add(name_lower)
-                unique_items.append(item)
+        prompt = page_prompt
+        if items:
+            prompt += (
+                f" These items were already extracted: {json.dumps(sorted(seen_names))}."
+                " Return ONLY the items that are not in this list, or an empty items array if there are none."
+            )
         
-        for item in unique_items:
-            item_id = str(uuid.uuid4())
-            current_price = float(item.get("current_price", 0))
-            food_cost = float(item.get("food_cost", 0))
-            profit = current_price - food_cost
+        try:
+            logger.info(f"Page {page_idx + 1} attempt {attempt + 1}: Using {llm_backend.name} backend")
             
-            # Calculate suggested price (targeting 30% food cost ratio)
-            suggested_price = round(food_cost / 0.30, 2) if food_cost > 0 else current_price
+            response = await llm_backend.extract_page(file_path, prompt)
+            prompt_tokens, output_tokens = response.prompt_tokens, response.output_tokens
+            record_llm_stat(stats, "calls")
+            record_llm_stat(stats, "prompt_tokens", prompt_tokens)
+            record_llm_stat(stats, "output_tokens", output_tokens)
             
-            processed_item = {
-                "id": item_id,
-                "name": item.get("name", "Unknown Item"),
-                "description": item.get("description"),
-                "current_price": current_price,
-                "suggested_price": suggested_price,
-                "approved_price": None,
-                "food_cost": food_cost,
-                "profit_per_plate": round(profit, 2),
-                "ingredients": item.get("ingredients", []),
-                "competitor_prices": [],
-                "price_decision": None
-            }
-            processed_items.append(processed_item)
-            total_food_cost += food_cost
-            total_profit += profit
+            page_items, complete = salvage_menu_items(response.text)
+        except Exception as e:
+            last_error = str(e)
+            logger.warning(f"Page {page_idx + 1} attempt {attempt + 1} failed: {last_error}")
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+            continue
+        
+        new_items = []
+        for item in page_items:
+            name_lower = item["name"].lower().strip()
+            if name_lower not in seen_names:
+                seen_names.add(name_lower)
+                new_items.append(item)
+        items.extend(new_items)
+        
+        if complete:
+            logger.info(f"Page {page_idx + 1}: Found {len(items)} items (attempt {attempt + 1})")
+            return items, True
+        
+        # Whatever this call produced beyond the salvaged items is lost
+        if new_items:
+            record_llm_stat(stats, "salvaged_items", len(new_items))
+        else:
+            record_llm_stat(stats, "wasted_tokens", prompt_tokens + output_tokens)
+        last_error = f"Incomplete JSON response ({len(new_items)} items salvaged)"
+        logger.warning(f"Page {page_idx + 1} attempt {attempt + 1}: {last_error}")
+    
+    if items:
+        logger.warning(f"Page {page_idx + 1}: keeping {len(items)} items from incomplete responses after {max_retries} attempts")
+        return items, False
+    
+    logger.error(f"Failed to analyze page {page_idx + 1} after {max_retries} attempts: {last_error}")
+    return None, False
+
+def build_menu_items(raw_items: List[dict], existing_items: Optional[List[dict]] = None) -> Dict[str, Any]:
+    """Dedupe raw extracted items by name and compute pricing fields and job totals.
+    
+    Items whose name matches one of `existing_items` keep the existing entry
+    as-is, so ingredient overrides, approvals and competitor data survive a
+    re-analysis.
+    """
+    existing_by_name = {
+        item.get("name", "").lower().strip(): item for item in existing_items or []
+    }
+    processed_items = []
+    total_food_cost = 0
+    total_profit = 0
+    
+    # Remove duplicates based on name (case-insensitive)
+    seen_names = set()
+    unique_items = []
+    for item in raw_items:
+        # Cache entries written before prices were validated may still hold bad items
+        if not _is_menu_item(item):
+            continue
+        name_lower = item["name"].lower().strip()
+        if name_lower not in seen_names:
+            seen_names.add(name_lower)
+            unique_items.append(item)
+    
+    for item in unique_items:
+        existing = existing_by_name.get(item.get("name", "").lower().strip())
+        if existing:
+            processed_items.append(existing)
+            total_food_cost += existing.get("food_cost") or 0
+            total_profit += existing.get("profit_per_plate") or 0
+            continue
+        
+        item_id = str(uuid.uuid4())
+        current_price = _optional_float(item.get("current_price")) or 0.0
+        food_cost = _optional_float(item.get("food_cost")) or 0.0
+        profit = current_price - food_cost
+        
+        # Calculate suggested price (targeting 30% food cost ratio)
+        suggested_price = round(food_cost / 0.30, 2) if food_cost > 0 else current_price
         
-        # Update job with results
+        processed_item = {
+            "id": item_id,
+            "name": item.get("name", "Unknown Item"),
+            "description": item.get("description"),
+            "current_price": current_price,
+            "suggested_price": suggested_price,
+            "approved_price": None,
+            "food_cost": food_cost,
+            "profit_per_plate": round(profit, 2),
+            "ingredients": item.get("ingredients", []),
+            "competitor_prices": [],
+            "price_decision": None
+        }
+        processed_items.append(processed_item)
+        total_food_cost += food_cost
+        total_profit += profit
+    
+    return {
+        "items": processed_items,
+        "total_food_cost": round(total_food_cost, 2),
+        "total_profit": round(total_profit, 2)
+    }
+
+# ============== EXTRACTION CACHE ==============
+
+# Parsed page items keyed by page content hash + EXTRACTION_VERSION. Each hit
+# refreshes `last_used_at`, which carries a TTL index, so entries that stop
+# being used age out; the collection is also trimmed LRU-first to a max size.
+
+def extraction_cache_key(page_hash: str) -> str:
+    return f"{EXTRACTION_VERSION}:{page_hash}"
+
+async def get_cached_extraction(page_hash: str) -> Optional[List[dict]]:
+    entry = await db.extraction_cache.find_one_and_update(
+        {"key": extraction_cache_key(page_hash)},
+        {"$set": {"last_used_at": datetime.now(timezone.utc)}, "$inc": {"hits": 1}},
+        projection={"_id": 0, "items": 1}
+    )
+    if entry is None:
+        metrics_counters["extraction_cache_misses"] += 1
+        return None
+    metrics_counters["extraction_cache_hits"] += 1
+    return entry["items"]
+
+async def store_cached_extraction(page_hash: str, items: List[dict]):
+    now = datetime.now(timezone.utc)
+    await db.extraction_cache.update_one(
+        {"key": extraction_cache_key(page_hash)},
+        {
+            "$set": {"items": items, "last_used_at": now},
+            "$setOnInsert": {"page_hash": page_hash, "version": EXTRACTION_VERSION, "created_at": now, "hits": 0}
+        },
+        upsert=True
+    )
+    await trim_extraction_cache()
+
+async def trim_extraction_cache():
+    overflow = await db.extraction_cache.estimated_document_count() - EXTRACTION_CACHE_MAX_ENTRIES
+    if overflow <= 0:
+        return
+    oldest = await db.extraction_cache.find({}, {"_id": 1}).sort("last_used_at", 1).limit(overflow).to_list(overflow)
+    await db.extraction_cache.delete_many({"_id": {"$in": [e["_id"] for e in oldest]}})
+    metrics_counters["extraction_cache_evictions"] += len(oldest)
+
+# ============== PAGE INGESTION ==============
+
+# Rasterization and image normalization are CPU-bound, so they run in worker
+# processes. Rendered and normalized pages are written next to the source file
+# and reused on later analyses. Workers come from a forkserver rather than a
+# fork of this process, whose Motor monitor and executor threads may hold
+# locks at fork time. The work functions live in media.py, so the workers
+# import that module alone rather than re-running this one.
+media_context = multiprocessing.get_context("forkserver")
+media_context.set_forkserver_preload(["media"])
+media_executor = ProcessPoolExecutor(max_workers=MEDIA_PROCESSES, mp_context=media_context)
+
+def is_pdf(file_path: str) -> bool:
+    return Path(file_path).suffix.lower() == ".pdf"
+
+async def count_menu_pages(file_paths: List[str]) -> List[int]:
+    loop = asyncio.get_running_loop()
+    counts = []
+    for file_path in file_paths:
+        if is_pdf(file_path):
+            counts.append(await loop.run_in_executor(media_executor, media.pdf_page_count, file_path))
+        else:
+            counts.append(1)
+    return counts
+
+async def iter_page_images(file_paths: List[str], page_counts: List[int], only: Optional[set] = None):
+    """Yield (file_path, page_idx, normalized_image_path) in page order, rasterizing PDF pages lazily.
+    
+    Files not in `only` are skipped, but still count towards page numbering.
+    """
+    loop = asyncio.get_running_loop()
+    page_idx = 0
+    
+    for file_path, page_count in zip(file_paths, page_counts):
+        if only is not None and file_path not in only:
+            page_idx += page_count
+            continue
+        
+        if not is_pdf(file_path):
+            yield file_path, page_idx, await loop.run_in_executor(
+                media_executor, media.normalize_image, file_path, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY
+            )
+            page_idx += 1
+            continue
+        
+        rendering = deque()
+        next_page = 0
+        while next_page < page_count or rendering:
+            while next_page < page_count and len(rendering) < PDF_RENDER_LOOKAHEAD:
+                rendering.append(loop.run_in_executor(
+                    media_executor, media.prepare_pdf_page, file_path, next_page,
+                    PDF_RENDER_DPI, IMAGE_MAX_EDGE, IMAGE_JPEG_QUALITY
+                ))
+                next_page += 1
+            yield file_path, page_idx, await rendering.popleft()
+            page_idx += 1
+
+async def fingerprint_files(job: dict, file_paths: List[str]) -> Dict[str, str]:
+    """Content hash per uploaded file, from upload metadata when available"""
+    loop = asyncio.get_running_loop()
+    known = {upload["path"]: upload["sha256"] for upload in job.get("uploads", [])}
+    fingerprints = {}
+    for file_path in file_paths:
+        fingerprints[file_path] = known.get(file_path) or await loop.run_in_executor(llm_executor, _hash_file, file_path)
+    return fingerprints
+
+async def run_menu_analysis(job: dict) -> Dict[str, Any]:
+    """Run the extraction for a job and return the fields to store on it.
+    
+    Raw items are stored per uploaded file in `page_results` together with the
+    file's fingerprint, so only new or changed files are extracted again and
+    their items are merged into the existing (possibly edited) item list.
+    """
+    # Get all file paths (support multi-page)
+    file_paths = job.get("file_paths", [job.get("file_path")])
+    fingerprints = await fingerprint_files(job, file_paths)
+    stored = {
+        result["path"]: result for result in job.get("page_results", [])
+        if result.get("version") == EXTRACTION_VERSION and result.get("fingerprint") == fingerprints.get(result["path"])
+    }
+    pending = [p for p in file_paths if p not in stored]
+    
+    counted = dict(zip(pending, await count_menu_pages(pending)))
+    page_counts = [stored[p]["pages"] if p in stored else counted[p] for p in file_paths]
+    total_pages = sum(page_counts)
+    
+    loop = asyncio.get_running_loop()
+    job_page_slots = asyncio.Semaphore(ANALYSIS_PAGE_CONCURRENCY)
+    
+    stats = defaultdict(int)
+    
+    async def extract(page_idx: int, image_path: str) -> Tuple[Optional[List[dict]], bool]:
+        try:
+            page_hash = await loop.run_in_executor(llm_executor, _hash_file, image_path)
+            cached = await get_cached_extraction(page_hash)
+            if cached is not None:
+                logger.info(f"Page {page_idx + 1}: {len(cached)} items from extraction cache")
+                stats["cache_hits"] += 1
+                return cached, True
+            
+            async with page_extraction_slots:
+                page_items, complete = await extract_page_items(image_path, page_idx, total_pages, stats)
+            if complete:
+                await store_cached_extraction(page_hash, page_items)
+            return page_items, complete
+        finally:
+            job_page_slots.release()
+    
+    # Pages are pulled from ingestion only when a job slot frees up, so PDF
+    # rendering stays just ahead of extraction. Tasks keep page order for dedup.
+    tasks = []
+    try:
+        async for file_path, page_idx, image_path in iter_page_images(file_paths, page_counts, only=set(pending)):
+            await job_page_slots.acquire()
+            tasks.append((file_path, asyncio.create_task(extract(page_idx, image_path))))
+        extracted = await asyncio.gather(*(task for _, task in tasks))
+    except BaseException:
+        for _, task in tasks:
+            task.cancel()
+        raise
+    
+    now = datetime.now(timezone.utc).isoformat()
+    fresh = {
+        file_path: {
+            "path": file_path,
+            "fingerprint": fingerprints[file_path],
+            "version": EXTRACTION_VERSION,
+            "pages": counted[file_path],
+            "items": [],
+            "extracted_at": now
+        }
+        for file_path in pending
+    }
+    for (file_path, _), (page_items, complete) in zip(tasks, extracted):
+        if not complete:
+            # Keep what was extracted, but retry this file next time
+            fresh[file_path]["fingerprint"] = None
+        fresh[file_path]["items"].extend(page_items or [])
+    
+    page_results = [stored.get(p) or fresh[p] for p in file_paths]
+    all_items = [item for result in page_results for item in result["items"]]
+    
+    result = build_menu_items(all_items, existing_items=job.get("items", []))
+    result["page_results"] = page_results
+    result["pages_analyzed"] = total_pages
+    result["pages_extracted"] = len(tasks)
+    result["analysis_stats"] = dict(stats)
+    logger.info(f"Job {job['id']}: extracted {len(tasks)} of {total_pages} page(s), reused {len(stored)} file(s)")
+    return result
+
+# ============== ANALYSIS QUEUE ==============
+
+# Jobs are queued by setting `queued_at` on a pending menu job. Workers claim
+# them atomically (pending -> analyzing) and hold a lease that is renewed while
+# they run, so jobs from a crashed worker are requeued once the lease expires.
+
+analysis_wakeup = asyncio.Event()
+background_tasks: List[asyncio.Task] = []
+
+def _lease_expiry() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=ANALYSIS_LEASE_SECONDS)).isoformat()
+
+async def claim_analysis_job(worker_id: str) -> Optional[dict]:
+    now = datetime.now(timezone.utc).isoformat()
+    return await db.menu_jobs.find_one_and_update(
+        {"status": "pending", "queued_at": {"$ne": None}},
+        {"$set": {
+            "status": "analyzing",
+            "queued_at": None,
+            "lease_owner": worker_id,
+            "lease_expires_at": _lease_expiry(),
+            "analysis_started_at": now,
+            "updated_at": now
+        }},
+        sort=[("queued_at", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_analysis_lease(job_id: str, worker_id: str):
+    while True:
+        await asyncio.sleep(ANALYSIS_LEASE_SECONDS / 3)
         await db.menu_jobs.update_one(
-            {"id": job_id},
-            {
-                "$set": {
-                    "status": "completed",
-                    "items": processed_items,
-                    "total_food_cost": round(total_food_cost, 2),
-                    "total_profit": round(total_profit, 2),
-                    "pages_analyzed": len(file_paths),
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
+            {"id": job_id, "lease_owner": worker_id},
+            {"$set": {"lease_expires_at": _lease_expiry()}}
+        )
+
+async def requeue_expired_analysis_jobs() -> int:
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.menu_jobs.update_many(
+        {"status": "analyzing", "lease_expires_at": {"$lt": now}},
+        {"$set": {"status": "pending", "queued_at": now, "lease_owner": None, "lease_expires_at": None, "updated_at": now}}
+    )
+    if result.modified_count:
+        logger.warning(f"Requeued {result.modified_count} analysis job(s) with expired leases")
+        analysis_wakeup.set()
+    return result.modified_count
+
+async def process_analysis_job(job: dict, worker_id: str):
+    job_id = job["id"]
+    release = {"lease_owner": None, "lease_expires_at": None}
+    heartbeat = asyncio.create_task(renew_analysis_lease(job_id, worker_id))
+    
+    try:
+        logger.info(f"{worker_id} analyzing job {job_id}")
+        result = await run_menu_analysis(job)
+    except Exception as e:
+        logger.error(f"Analysis error for job {job_id}: {str(e)}")
+        await db.menu_jobs.update_one(
+            {"id": job_id, "lease_owner": worker_id},
+            {"$set": {
+                "status": "pending",
+                "analysis_error": f"Analysis failed: {str(e)}",
+                **release,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        return
+    finally:
+        heartbeat.cancel()
+    
+    # Items were merged into the job as it was when claimed. The write is
+    # guarded by updated_at, so an edit or approval made while the analysis
+    # ran forces a re-read and a fresh merge instead of being overwritten.
+    extracted = [item for page in result["page_results"] for item in page["items"]]
+    for _ in range(5):
+        now = datetime.now(timezone.utc).isoformat()
+        written = await db.menu_jobs.update_one(
+            {"id": job_id, "lease_owner": worker_id, "updated_at": job.get("updated_at")},
+            {"$set": {
+                **result,
+                "status": "completed",
+                **release,
+                "analysis_completed_at": now,
+                "updated_at": now
+            }}
+        )
+        if written.matched_count:
+            break
+        job = await db.menu_jobs.find_one(
+            {"id": job_id, "lease_owner": worker_id},
+            {"_id": 0, "items": 1, "updated_at": 1}
+        )
+        if not job:
+            logger.warning(f"{worker_id} lost the lease on job {job_id} before saving its analysis")
+            return
+        result.update(build_menu_items(extracted, existing_items=job.get("items", [])))
+    else:
+        logger.error(f"{worker_id} could not save job {job_id}: modified concurrently")
+        await db.menu_jobs.update_one(
+            {"id": job_id, "lease_owner": worker_id},
+            {"$set": {
+                "status": "pending",
+                "analysis_error": "Analysis failed: menu was modified concurrently, please retry",
+                **release,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
         )
+        return
+    logger.info(f"{worker_id} completed job {job_id}: {len(result['items'])} items from {result['pages_analyzed']} page(s)")
+
+async def analysis_worker(worker_id: str):
+    while True:
+        try:
+            job = await claim_analysis_job(worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"{worker_id} failed to claim job: {str(e)}")
+            job = None
         
-        return {"message": "Analysis complete", "items_found": len(processed_items), "pages_analyzed": len(file_paths)}
+        if job:
+            try:
+                await process_analysis_job(job, worker_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{worker_id} failed to finalize job {job['id']}: {str(e)}")
+            continue
         
-    except Exception as e:
-        logger.error(f"Analysis error: {str(e)}")
-        await db.menu_jobs.update_one({"id": job_id}, {"$set": {"status": "pending"}})
-        raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
+        # Idle: wait for a new submission or fall back to polling
+        analysis_wakeup.clear()
+        try:
+            await asyncio.wait_for(analysis_wakeup.wait(), timeout=ANALYSIS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def analysis_reaper():
+    while True:
+        try:
+            await requeue_expired_analysis_jobs()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to requeue expired analysis jobs: {str(e)}")
+        await asyncio.sleep(ANALYSIS_LEASE_SECONDS / 2)
+
+# ============== CONDITIONAL GET ==============
+
+# Clients may keep menu representations but must revalidate them with If-None-Match
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+def menu_etag(versions: List[Tuple[str, Optional[str]]], variant: str = "") -> str:
+    """Strong ETag for a representation built from menus at the given (id, updated_at) versions"""
+    digest = hashlib.sha256(variant.encode())
+    for job_id, updated_at in versions:
+        digest.update(f"|{job_id}:{updated_at}".encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # If-None-Match uses weak comparison
+    return "*" in candidates or etag in (tag[2:] if tag.startswith("W/") else tag for tag in candidates)
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL})
+
+def etag_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+
+# ============== MENU ROUTES ==============
+
+def new_menu_job(job_id: str, user: dict, name: str, location: Optional[str], uploads: List[dict]) -> dict:
+    file_paths = [upload["path"] for upload in uploads]
+    return {
+        "id": job_id,
+        "user_id": user["id"],
+        "name": name,
+        "status": "pending",
+        "file_path": file_paths[0] if file_paths else None,  # Legacy support
+        "file_paths": file_paths,  # All uploaded files
+        "uploads": uploads,  # Per-file size and content hash
+        "items": [],
+        "location": location or user.get("location"),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+@api_router.post("/menus/upload")
+async def upload_menu(
+    request: Request,
+    name: Optional[str] = None,
+    location: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """Upload one or more menu files (images or PDFs) for analysis.
+    
+    The body is parsed by hand rather than through `UploadFile` so nothing is
+    read until the caller is authenticated and holds a credit.
+    """
+    job_id = str(uuid.uuid4())
+    uploads = []
+    reserved = False
+    
+    try:
+        # Reserve the credit before reading the body; it is refunded if the upload fails
+        await reserve_credit(user["id"], "menu_upload", job_id)
+        reserved = True
+        
+        uploads, fields = await receive_uploads(request, "files")
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No files provided")
+        
+        # The web client sends name and location as form fields
+        name = fields.get("name") or name or "Uploaded Menu"
+        location = fields.get("location") or location
+        file_paths = [upload["path"] for upload in uploads]
+        
+        # Create menu job
+        await db.menu_jobs.insert_one(new_menu_job(job_id, user, name, location, uploads))
+    except BaseException:
+        for upload in uploads:
+            Path(upload["path"]).unlink(missing_ok=True)
+        if reserved:
+            await refund_credit(user["id"], "menu_upload", job_id)
+        raise
+    await mark_recent_write(user)
+    
+    logger.info(f"Created job {job_id} with {len(file_paths)} file(s)")
+    return {"job_id": job_id, "message": f"Menu uploaded successfully ({len(file_paths)} page(s)). Analysis will begin shortly.", "total_pages": len(file_paths)}
+
+@api_router.post("/menus/{job_id}/add-page")
+async def add_menu_page(
+    job_id: str,
+    request: Request,
+    user: dict = Depends(get_current_user)
+):
+    """Add additional pages to an existing menu job"""
+    job = await db.menu_jobs.find_one(
+        {"id": job_id, "user_id": user["id"]},
+        {"_id": 0, "file_path": 1, "file_paths": 1}
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Menu job not found")
+    
+    # Save uploaded file
+    uploads, _ = await receive_uploads(request, "file", max_files=1)
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No file provided")
+    upload = uploads[0]
+    
+    # Append to file_paths atomically (legacy jobs only have file_path)
+    now = datetime.now(timezone.utc).isoformat()
+    if "file_paths" in job:
+        update = {"$push": {"file_paths": upload["path"], "uploads": upload}, "$set": {"updated_at": now}}
+    else:
+        update = {"$set": {"file_paths": [job.get("file_path"), upload["path"]], "updated_at": now}, "$push": {"uploads": upload}}
+    
+    job = await db.menu_jobs.find_one_and_update(
+        {"id": job_id, "user_id": user["id"]},
+        update,
+        projection={"_id": 0, "file_paths": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not job:
+        # Deleted while the upload was streaming in
+        Path(upload["path"]).unlink(missing_ok=True)
+        raise HTTPException(status_code=404, detail="Menu job not found")
+    file_paths = job["file_paths"]
+    
+    return {"message": f"Page added. Total pages: {len(file_paths)}", "total_pages": len(file_paths)}
+
+@api_router.post("/menus/{job_id}/analyze", status_code=202)
+async def analyze_menu(job_id: str, user: dict = Depends(get_current_user)):
+    """Queue a menu job for analysis; a background worker picks it up"""
+    now = datetime.now(timezone.utc).isoformat()
+    job = await db.menu_jobs.find_one_and_update(
+        {"id": job_id, "user_id": user["id"], "status": {"$in": ["pending", "completed", "approved"]}},
+        {"$set": {"status": "pending", "queued_at": now, "analysis_error": None, "updated_at": now}},
+        projection={"_id": 0, "id": 1}
+    )
+    if not job:
+        existing = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0, "status": 1})
+        if not existing:
+            raise HTTPException(status_code=404, detail="Menu job not found")
+        raise HTTPException(status_code=400, detail=f"Cannot analyze menu in {existing['status']} status")
+    
+    analysis_wakeup.set()
+    logger.info(f"Queued job {job_id} for analysis")
+    return {"message": "Analysis queued", "job_id": job_id, "status": "pending"}
+
+MENU_LIST_DEFAULT_LIMIT = 50
+MENU_LIST_MAX_LIMIT = 100
+
+# What the dashboard and saved-menus list need; item_count is computed in
+# Mongo so the items array never leaves the database
+MENU_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "name": 1,
+    "status": 1,
+    "location": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "total_food_cost": 1,
+    "total_profit": 1,
+    "analysis_error": 1,
+    "item_count": {"$size": {"$ifNull": ["$items", []]}}
+}
+
+def encode_menu_cursor(job: dict) -> str:
+    raw = json.dumps([job["created_at"], job["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
-@api_router.get("/menus", response_model=List[dict])
-async def get_menus(user: dict = Depends(get_current_user)):
-    jobs = await db.menu_jobs.find({"user_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return jobs
+def decode_menu_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(created_at), str(job_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@api_router.get("/menus")
+async def get_menus(
+    cursor: Optional[str] = None,
+    limit: int = MENU_LIST_DEFAULT_LIMIT,
+    full: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user)
+):
+    """Newest-first menus, keyset-paginated on (created_at, id)"""
+    limit = max(1, min(limit, MENU_LIST_MAX_LIMIT))
+    match = {"user_id": user["id"]}
+    if cursor:
+        created_at, job_id = decode_menu_cursor(cursor)
+        match["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": job_id}}
+        ]
+    
+    reader = read_db("listing", user)
+    variant = f"list:{cursor}:{limit}:{full}"
+    
+    def page(projection):
+        return reader.menu_jobs.aggregate([
+            {"$match": match},
+            {"$sort": {"created_at": -1, "id": -1}},
+            {"$limit": limit + 1},
+            {"$project": projection}
+        ]).to_list(limit + 1)
+    
+    if if_none_match:
+        versions = await page({"_id": 0, "id": 1, "updated_at": 1})
+        etag = menu_etag([(job["id"], job.get("updated_at")) for job in versions], variant)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    jobs = await page({"_id": 0, "page_results": 0} if full else MENU_SUMMARY_PROJECTION)
+    etag = menu_etag([(job["id"], job.get("updated_at")) for job in jobs], variant)
+    
+    next_cursor = encode_menu_cursor(jobs[limit - 1]) if len(jobs) > limit else None
+    # Mongo documents are already JSON-safe; returning the response skips jsonable_encoder
+    return ORJSONResponse({"menus": jobs[:limit], "next_cursor": next_cursor}, headers=etag_headers(etag))
 
 @api_router.get("/menus/{job_id}")
-async def get_menu(job_id: str, user: dict = Depends(get_current_user)):
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
+async def get_menu(job_id: str, if_none_match: Optional[str] = Header(None), user: dict = Depends(get_current_user)):
+    if if_none_match:
+        # Analysis polling: answer from updated_at alone when nothing changed
+        version = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0, "updated_at": 1})
+        if not version:
+            raise HTTPException(status_code=404, detail="Menu job not found")
+        etag = menu_etag([(job_id, version.get("updated_at"))], "menu")
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+    
+    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0, "page_results": 0})
     if not job:
         raise HTTPException(status_code=404, detail="Menu job not found")
-    return job
+    return ORJSONResponse(job, headers=etag_headers(menu_etag([(job_id, job.get("updated_at"))], "menu")))
 
 # Model for ingredient update
 class IngredientUpdate(BaseModel):
@@ -565,105 +1838,156 @@ async def update_item_ingredients(
     user: dict = Depends(get_current_user)
 ):
     """Update ingredient prices for a menu item and recalculate food cost"""
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
-    if not job:
-        raise HTTPException(status_code=404, detail="Menu job not found")
-    
-    items = job.get("items", [])
-    item_found = False
-    
-    for item in items:
-        if item["id"] == item_id:
-            item_found = True
+    ingredients = [ing.model_dump() for ing in update.ingredients]
+    new_food_cost = sum(ing.estimated_cost for ing in update.ingredients)
+    
+    # Optimistic retry: the write only applies if the item's cost and pricing
+    # are unchanged since we read them, so concurrent edits are never lost
+    for _ in range(5):
+        job = await db.menu_jobs.find_one(
+            {"id": job_id, "user_id": user["id"], "items.id": item_id},
+            {"_id": 0, "items.$": 1}
+        )
+        if not job:
+            if not await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail="Menu job not found")
+            raise HTTPException(status_code=404, detail="Menu item not found")
+        
+        item = job["items"][0]
+        changes = {
             # Update ingredients
-            item["ingredients"] = [ing.model_dump() for ing in update.ingredients]
-            
+            "ingredients": ingredients,
             # Recalculate food cost
-            new_food_cost = sum(ing.estimated_cost for ing in update.ingredients)
-            item["food_cost"] = round(new_food_cost, 2)
-            
-            # Recalculate food cost percentage
-            if item.get("current_price", 0) > 0:
-                item["food_cost_pct"] = round((new_food_cost / item["current_price"]) * 100, 1)
-            
-            # Recalculate suggested price (target 30% food cost)
-            if new_food_cost > 0:
-                item["suggested_price"] = round(new_food_cost / 0.30, 2)
-            
-            # Recalculate profit per plate
-            if item.get("approved_price"):
-                item["profit_per_plate"] = round(item["approved_price"] - new_food_cost, 2)
-            elif item.get("current_price"):
-                item["profit_per_plate"] = round(item["current_price"] - new_food_cost, 2)
-            
-            break
-    
-    if not item_found:
-        raise HTTPException(status_code=404, detail="Menu item not found")
-    
-    # Update the menu job
-    await db.menu_jobs.update_one(
-        {"id": job_id},
-        {
-            "$set": {
-                "items": items,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
+            "food_cost": round(new_food_cost, 2)
         }
-    )
+        
+        # Recalculate food cost percentage
+        if item.get("current_price", 0) > 0:
+            changes["food_cost_pct"] = round((new_food_cost / item["current_price"]) * 100, 1)
+        
+        # Recalculate suggested price (target 30% food cost)
+        if new_food_cost > 0:
+            changes["suggested_price"] = round(new_food_cost / 0.30, 2)
+        
+        # Recalculate profit per plate
+        if item.get("approved_price"):
+            changes["profit_per_plate"] = round(item["approved_price"] - new_food_cost, 2)
+        elif item.get("current_price"):
+            changes["profit_per_plate"] = round(item["current_price"] - new_food_cost, 2)
+        
+        # Keep job totals in step with the item
+        totals = {
+            "total_food_cost": changes["food_cost"] - (item.get("food_cost") or 0),
+            "total_profit": changes.get("profit_per_plate", item.get("profit_per_plate") or 0) - (item.get("profit_per_plate") or 0)
+        }
+        
+        result = await db.menu_jobs.update_one(
+            {
+                "id": job_id,
+                "user_id": user["id"],
+                "items": {"$elemMatch": {
+                    "id": item_id,
+                    "food_cost": item.get("food_cost"),
+                    "approved_price": item.get("approved_price"),
+                    "profit_per_plate": item.get("profit_per_plate")
+                }}
+            },
+            {
+                "$set": {
+                    **{f"items.$.{field}": value for field, value in changes.items()},
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                },
+                "$inc": totals
+            }
+        )
+        if result.matched_count:
+            await mark_recent_write(user)
+            return {
+                "message": "Ingredients updated successfully",
+                "item": {**item, **changes}
+            }
     
-    # Return the updated item
-    updated_item = next((i for i in items if i["id"] == item_id), None)
-    return {
-        "message": "Ingredients updated successfully",
-        "item": updated_item
-    }
+    raise HTTPException(status_code=409, detail="Menu item was modified concurrently, please retry")
+
+def item_array_update(changes: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Any], List[dict]]:
+    """$set fields and arrayFilters that update several embedded items in one write"""
+    sets = {}
+    array_filters = []
+    for n, (item_id, fields) in enumerate(changes.items()):
+        for field, value in fields.items():
+            sets[f"items.$[i{n}].{field}"] = value
+        array_filters.append({f"i{n}.id": item_id})
+    return sets, array_filters
 
 @api_router.post("/menus/{job_id}/approve")
 async def approve_prices(job_id: str, approvals: List[PriceApproval], user: dict = Depends(get_current_user)):
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
-    if not job:
-        raise HTTPException(status_code=404, detail="Menu job not found")
-    
-    items = job.get("items", [])
     approval_map = {a.item_id: a for a in approvals}
-    
-    total_profit = 0
-    total_revenue = 0
-    total_food_cost = 0
-    
-    for item in items:
-        if item["id"] in approval_map:
-            approval = approval_map[item["id"]]
-            item["price_decision"] = approval.decision
-            
-            if approval.decision == "maintain":
-                item["approved_price"] = item["current_price"]
-            elif approval.decision == "increase":
-                item["approved_price"] = item["suggested_price"]
-            elif approval.decision == "decrease":
-                # Decrease by 10% from suggested
-                item["approved_price"] = round(item["suggested_price"] * 0.9, 2)
-            elif approval.decision == "custom" and approval.custom_price:
-                item["approved_price"] = approval.custom_price
-            
-            if item["approved_price"] and item.get("food_cost"):
-                item["profit_per_plate"] = round(item["approved_price"] - item["food_cost"], 2)
-                total_profit += item["profit_per_plate"]
-                total_revenue += item["approved_price"]
-                total_food_cost += item["food_cost"]
-    
-    await db.menu_jobs.update_one(
-        {"id": job_id},
-        {
-            "$set": {
-                "status": "approved",
-                "items": items,
-                "total_profit": round(total_profit, 2),
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
-        }
-    )
+    item_fields = ["id", "name", "current_price", "suggested_price", "food_cost", "approved_price", "profit_per_plate", "price_decision"]
+    
+    # Only pricing fields are read, and every approved item is written in a
+    # single update guarded by updated_at; a concurrent edit forces a re-read
+    for _ in range(5):
+        job = await db.menu_jobs.find_one(
+            {"id": job_id, "user_id": user["id"]},
+            {"_id": 0, "name": 1, "updated_at": 1, **{f"items.{field}": 1 for field in item_fields}}
+        )
+        if not job:
+            raise HTTPException(status_code=404, detail="Menu job not found")
+        
+        items = job.get("items", [])
+        changes = {}
+        
+        total_profit = 0
+        total_revenue = 0
+        total_food_cost = 0
+        profit_delta = 0
+        
+        for item in items:
+            if item["id"] in approval_map:
+                approval = approval_map[item["id"]]
+                previous_profit = item.get("profit_per_plate") or 0
+                item["price_decision"] = approval.decision
+                
+                if approval.decision == "maintain":
+                    item["approved_price"] = item["current_price"]
+                elif approval.decision == "increase":
+                    item["approved_price"] = item["suggested_price"]
+                elif approval.decision == "decrease":
+                    # Decrease by 10% from suggested
+                    item["approved_price"] = round(item["suggested_price"] * 0.9, 2)
+                elif approval.decision == "custom" and approval.custom_price:
+                    item["approved_price"] = approval.custom_price
+                
+                if item.get("approved_price") and item.get("food_cost"):
+                    item["profit_per_plate"] = round(item["approved_price"] - item["food_cost"], 2)
+                    total_profit += item["profit_per_plate"]
+                    total_revenue += item["approved_price"]
+                    total_food_cost += item["food_cost"]
+                
+                profit_delta += (item.get("profit_per_plate") or 0) - previous_profit
+                changes[item["id"]] = {
+                    "price_decision": item["price_decision"],
+                    "approved_price": item.get("approved_price"),
+                    "profit_per_plate": item.get("profit_per_plate")
+                }
+        
+        sets, array_filters = item_array_update(changes)
+        result = await db.menu_jobs.update_one(
+            {"id": job_id, "user_id": user["id"], "updated_at": job.get("updated_at")},
+            {
+                "$set": {
+                    **sets,
+                    "status": "approved",
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                },
+                "$inc": {"total_profit": round(profit_delta, 2)}
+            },
+            array_filters=array_filters or None
+        )
+        if result.matched_count:
+            break
+    else:
+        raise HTTPException(status_code=409, detail="Menu was modified concurrently, please retry")
     
     # Save price history snapshot for comparison tracking
     snapshot = {
@@ -689,7 +2013,25 @@ async def approve_prices(job_id: str, approvals: List[PriceApproval], user: dict
             for item in items if item.get("approved_price")
         ]
     }
-    await db.price_history.insert_one(snapshot)
+    # Each base takes at most one delta (unique index), so a chain stays
+    # linear when two approvals race; the loser re-encodes against the winner
+    for _ in range(5):
+        previous = await latest_snapshot_state(job_id, user["id"])
+        try:
+            await db.price_history.insert_one(encode_snapshot(snapshot, previous))
+            break
+        except DuplicateKeyError:
+            snapshot["snapshot_date"] = datetime.now(timezone.utc).isoformat()
+    else:
+        raise HTTPException(status_code=409, detail="Menu was modified concurrently, please retry")
+    first_for_menu = previous is None
+    try:
+        await apply_snapshot_to_rollup(snapshot, first_for_menu)
+    except Exception as e:
+        # The snapshot is the source of truth; drop the rollup so the next read rebuilds it
+        logger.error(f"Failed to update analytics rollup for user {user['id']}: {str(e)}")
+        await discard_analytics_rollup(user["id"])
+    await mark_recent_write(user)
     
     return {"message": "Prices approved successfully", "snapshot_id": snapshot["id"]}
 
@@ -698,13 +2040,17 @@ async def delete_menu(job_id: str, user: dict = Depends(get_current_user)):
     result = await db.menu_jobs.delete_one({"id": job_id, "user_id": user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Menu job not found")
+    await mark_recent_write(user)
     return {"message": "Menu deleted successfully"}
 
 # ============== COMPETITOR ANALYSIS ==============
 
 @api_router.post("/menus/{job_id}/competitor-analysis")
 async def analyze_competitors(job_id: str, user: dict = Depends(get_current_user)):
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
+    job = await db.menu_jobs.find_one(
+        {"id": job_id, "user_id": user["id"]},
+        {"_id": 0, "location": 1, "items.id": 1, "items.name": 1, "items.current_price": 1, "items.food_cost": 1}
+    )
     if not job:
         raise HTTPException(status_code=404, detail="Menu job not found")
     
@@ -716,10 +2062,7 @@ async def analyze_competitors(job_id: str, user: dict = Depends(get_current_user
     
     # Use AI to generate realistic competitor pricing based on location and item types
     try:
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"competitor-{job_id}",
-            system_message=f"""You are a restaurant market analyst. For the given menu items and location ({location}), 
+        system_prompt = f"""You are a restaurant market analyst. For the given menu items and location ({location}), 
             provide realistic competitor pricing data from 4-5 nearby restaurants within a 60-mile radius.
             Create realistic restaurant names that fit the local market.
             Consider local market conditions, restaurant types, and typical pricing strategies.
@@ -743,17 +2086,15 @@ async def analyze_competitors(job_id: str, user: dict = Depends(get_current_user
                 ]
             }}
             """
-        ).with_model("gemini", "gemini-2.5-flash")
         
         item_names = [item["name"] for item in items[:10]]  # Limit to 10 items
-        message = UserMessage(
-            text=f"Analyze competitor pricing for these menu items in {location} (60-mile radius): {json.dumps(item_names)}"
+        response = await llm_backend.generate_json(
+            system_prompt,
+            f"Analyze competitor pricing for these menu items in {location} (60-mile radius): {json.dumps(item_names)}"
         )
         
-        response = await chat.send_message(message)
-        
         # Parse response
-        clean_response = response.strip()
+        clean_response = response.text.strip()
         if clean_response.startswith("```"):
             clean_response = clean_response.split("```")[1]
             if clean_response.startswith("json"):
@@ -767,27 +2108,32 @@ async def analyze_competitors(job_id: str, user: dict = Depends(get_current_user
         # Update items with competitor data
         competitor_map = {c["item_name"]: c for c in competitor_data.get("competitors", [])}
         
+        changes = {}
         for item in items:
             if item["name"] in competitor_map:
                 comp_info = competitor_map[item["name"]]
-                item["competitor_prices"] = comp_info.get("competitor_prices", [])
-                item["avg_market_price"] = comp_info.get("avg_market_price")
-                item["market_price_range"] = comp_info.get("price_range")
+                item_changes = {
+                    "competitor_prices": comp_info.get("competitor_prices", []),
+                    "avg_market_price": comp_info.get("avg_market_price"),
+                    "market_price_range": comp_info.get("price_range")
+                }
                 
                 # Update suggested price based on competitor average
-                if item["competitor_prices"]:
-                    avg_competitor = sum(p["price"] for p in item["competitor_prices"]) / len(item["competitor_prices"])
+                if item_changes["competitor_prices"]:
+                    avg_competitor = sum(p["price"] for p in item_changes["competitor_prices"]) / len(item_changes["competitor_prices"])
                     food_cost = item.get("food_cost", 0)
                     
                     # Suggest price: competitive but maintains at least 30% food cost ratio
                     min_price_for_margin = food_cost / 0.30 if food_cost > 0 else item["current_price"]
-                    item["suggested_price"] = round(max(avg_competitor * 0.97, min_price_for_margin), 2)
+                    item_changes["suggested_price"] = round(max(avg_competitor * 0.97, min_price_for_margin), 2)
+                changes[item["id"]] = item_changes
         
-        # Store competitor metadata with the job
+        # Store competitor data on the matched items and metadata on the job
+        sets, array_filters = item_array_update(changes)
         await db.menu_jobs.update_one(
             {"id": job_id},
             {"$set": {
-                "items": items, 
+                **sets,
                 "competitor_analysis": {
                     "location": location,
                     "radius_miles": 60,
@@ -795,14 +2141,16 @@ async def analyze_competitors(job_id: str, user: dict = Depends(get_current_user
                     "analyzed_at": datetime.now(timezone.utc).isoformat()
                 },
                 "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+            }},
+            array_filters=array_filters or None
         )
+        await mark_recent_write(user)
         
         return {
             "message": "Competitor analysis complete",
             "location": location,
             "restaurants_analyzed": restaurants_analyzed,
-            "items_analyzed": len([i for i in items if i.get("competitor_prices")])
+            "items_analyzed": len([c for c in changes.values() if c["competitor_prices"]])
         }
         
     except Exception as e:
@@ -918,36 +2266,366 @@ async def search_location(query: str, user: dict = Depends(get_current_user)):
     
     return {"results": []}
 
+# ============== PRICE HISTORY ==============
+
+# Storage-only fields that never appear in API responses
+SNAPSHOT_ENCODING_FIELDS = ("encoding", "keyframe_id", "base_id", "chain_length", "changed_items", "removed_items")
+
+def encode_snapshot(snapshot: dict, previous: Optional[dict]) -> dict:
+    """Stored form of a full snapshot: a keyframe, or only what changed since `previous`
+
+    `previous` is the menu's latest snapshot state from latest_snapshot_state,
+    or None for the menu's first snapshot.
+    """
+    after = {item.get("name"): item for item in snapshot["items"]}
+    if (
+        not previous
+        or previous.get("legacy")
+        or previous["chain_length"] + 1 >= PRICE_HISTORY_KEYFRAME_INTERVAL
+        or len(after) != len(snapshot["items"])  # duplicate names can't be diffed by name
+    ):
+        return {**snapshot, "encoding": "keyframe", "keyframe_id": snapshot["id"], "chain_length": 0}
+    
+    before = {item.get("name"): item for item in previous["items"]}
+    headers = {key: value for key, value in snapshot.items() if key != "items"}
+    return {
+        **headers,
+        "encoding": "delta",
+        "keyframe_id": previous["keyframe_id"],
+        "base_id": previous["id"],
+        "chain_length": previous["chain_length"] + 1,
+        "changed_items": [item for name, item in after.items() if before.get(name) != item],
+        "removed_items": [name for name in before if name not in after]
+    }
+
+def replay_snapshot_chains(docs: List[dict]) -> Dict[str, List[dict]]:
+    """Items of every stored snapshot in `docs`, by snapshot id
+
+    `docs` must be in snapshot_date order and include each delta's keyframe
+    and bases.
+    """
+    states = {}
+    for doc in docs:
+        if doc.get("encoding") != "delta":
+            states[doc["id"]] = list(doc.get("items", []))
+            continue
+        base = states.get(doc["base_id"])
+        if base is None:
+            logger.error(f"Price snapshot {doc['id']} is missing its base {doc['base_id']}")
+            base = []
+        removed = set(doc.get("removed_items", []))
+        items = {item.get("name"): item for item in base if item.get("name") not in removed}
+        for item in doc.get("changed_items", []):
+            items[item.get("name")] = item
+        states[doc["id"]] = list(items.values())
+    return states
+
+async def expand_snapshots(reader, user_id: str, docs: List[dict]) -> List[dict]:
+    """Snapshots in their API shape (full item lists), whatever their stored encoding"""
+    # Chains are only fetched when a delta's base isn't already among `docs`
+    ids = {doc["id"] for doc in docs}
+    missing = list({
+        doc["keyframe_id"] for doc in docs
+        if doc.get("encoding") == "delta" and doc["base_id"] not in ids
+    })
+    replay = [doc for doc in docs if doc.get("keyframe_id") not in missing]
+    if missing:
+        replay += await reader.price_history.find(
+            {"user_id": user_id, "keyframe_id": {"$in": missing}},
+            {"_id": 0}
+        ).to_list(None)
+    states = replay_snapshot_chains(sorted(replay, key=lambda doc: doc.get("snapshot_date", "")))
+    
+    return [
+        {
+            **{key: value for key, value in doc.items() if key not in SNAPSHOT_ENCODING_FIELDS},
+            "items": states[doc["id"]]
+        }
+        for doc in docs
+    ]
+
+async def latest_snapshot_state(menu_id: str, user_id: str) -> Optional[dict]:
+    """The menu's newest snapshot with reconstructed items, for encoding the next one"""
+    latest = await db.price_history.find_one(
+        {"menu_id": menu_id, "user_id": user_id},
+        {"_id": 0},
+        sort=[("snapshot_date", -1)]
+    )
+    if not latest:
+        return None
+    if not latest.get("encoding"):
+        # Written before delta encoding: start a fresh chain with a keyframe
+        return {"id": latest["id"], "legacy": True}
+    
+    expanded = await expand_snapshots(db, user_id, [latest])
+    return {
+        "id": latest["id"],
+        "keyframe_id": latest["keyframe_id"],
+        "chain_length": latest["chain_length"],
+        "items": expanded[0]["items"]
+    }
+
+async def iter_expanded_snapshots(reader, user_id: str):
+    """Yield every snapshot of a user in API shape, holding one chain in memory at a time"""
+    cursor = reader.price_history.find(
+        {"user_id": user_id},
+        {"_id": 0}
+    ).sort([("keyframe_id", 1), ("snapshot_date", 1)])
+    
+    chain = []
+    async for doc in cursor:
+        if chain and (doc.get("keyframe_id") != chain[0].get("keyframe_id") or not doc.get("keyframe_id")):
+            for expanded in await expand_snapshots(reader, user_id, chain):
+                yield expanded
+            chain = []
+        chain.append(doc)
+    for expanded in await expand_snapshots(reader, user_id, chain):
+        yield expanded
+
+# ============== ANALYTICS ROLLUPS ==============
+
+ANALYTICS_TREND_WINDOW = 10
+ANALYTICS_TOP_ITEMS = 10
+
+def _trend_entry(snapshot: dict) -> dict:
+    return {
+        "date": snapshot.get("snapshot_date", "")[:10],
+        "menu": snapshot.get("menu_name", "")[:20],
+        "revenue": snapshot.get("total_revenue", 0),
+        "food_cost": snapshot.get("total_food_cost", 0),
+        "profit": snapshot.get("total_profit", 0)
+    }
+
+def _item_profits(snapshots) -> Dict[str, dict]:
+    """Per-item profit totals and counts across snapshots, keyed by item name"""
+    totals = {}
+    for snapshot in snapshots:
+        for item in snapshot.get("items", []):
+            name = item.get("name", "Unknown")
+            entry = totals.setdefault(name, {"total_profit": 0, "count": 0})
+            entry["total_profit"] += item.get("profit") or 0
+            entry["count"] += 1
+    return totals
+
+def snapshot_totals_pipeline(user_id: str) -> List[dict]:
+    """Running totals and distinct menu count over a user's snapshots"""
+    return [
+        {"$match": {"user_id": user_id}},
+        {"$group": {
+            "_id": None,
+            "total_snapshots": {"$sum": 1},
+            "total_revenue": {"$sum": "$total_revenue"},
+            "total_food_cost": {"$sum": "$total_food_cost"},
+            "total_profit": {"$sum": "$total_profit"},
+            "total_items": {"$sum": "$total_items"},
+            "menu_ids": {"$addToSet": "$menu_id"}
+        }},
+        {"$project": {
+            "_id": 0,
+            "total_snapshots": 1,
+            "total_revenue": 1,
+            "total_food_cost": 1,
+            "total_profit": 1,
+            "total_items": 1,
+            "total_menus_analyzed": {"$size": "$menu_ids"}
+        }}
+    ]
+
+def stored_item_rows(fields: List[str]) -> dict:
+    """$project expression for the item rows a stored snapshot carries.
+    
+    Keyframes (and pre-delta snapshots) carry every item; deltas carry their
+    changed items plus a `removed` marker row per dropped name. Replaying a
+    chain's rows in (chain_length, index) order gives each snapshot's items.
+    """
+    row = {**{field: f"$$this.{field}" for field in fields}, "removed": False}
+    # A missing name and a null one are the same item to replay (item.get("name"))
+    row["name"] = {"$ifNull": ["$$this.name", None]}
+    return {"$cond": [
+        {"$eq": ["$encoding", "delta"]},
+        {"$concatArrays": [
+            {"$map": {"input": {"$ifNull": ["$changed_items", []]}, "in": row}},
+            {"$map": {"input": {"$ifNull": ["$removed_items", []]}, "in": {"name": "$$this", "removed": True}}}
+        ]},
+        {"$map": {"input": {"$ifNull": ["$items", []]}, "in": row}}
+    ]}
+
+def item_profits_pipeline(user_id: str) -> List[dict]:
+    """Per-item profit totals across a user's snapshots, computed on their stored (delta) form.
+    
+    A row counts once for every snapshot from its own up to the next row for
+    the same name in its chain, or to the chain's end. Duplicate names within
+    a keyframe only count in the keyframe itself, as replay keeps the last.
+    """
+    return [
+        {"$match": {"user_id": user_id}},
+        {"$project": {
+            "_id": 0,
+            "chain": {"$ifNull": ["$keyframe_id", "$id"]},
+            "position": {"$ifNull": ["$chain_length", 0]},
+            "rows": stored_item_rows(["name", "profit"])
+        }},
+        {"$group": {
+            "_id": "$chain",
+            "end": {"$max": "$position"},
+            "docs": {"$push": {"position": "$position", "rows": "$rows"}}
+        }},
+        {"$unwind": "$docs"},
+        {"$unwind": {"path": "$docs.rows", "includeArrayIndex": "index"}},
+        {"$sort": {"_id": 1, "docs.rows.name": 1, "docs.position": 1, "index": 1}},
+        {"$group": {
+            "_id": {"chain": "$_id", "name": "$docs.rows.name"},
+            "end": {"$first": "$end"},
+            "rows": {"$push": {"position": "$docs.position", "profit": "$docs.rows.profit", "removed": "$docs.rows.removed"}}
+        }},
+        {"$project": {
+            "_id": 0,
+            "name": "$_id.name",
+            "spans": {"$map": {
+                "input": {"$range": [0, {"$size": "$rows"}]},
+                "as": "i",
+                "in": {"$let": {
+                    "vars": {
+                        "row": {"$arrayElemAt": ["$rows", "$$i"]},
+                        "next": {"$arrayElemAt": ["$rows", {"$add": ["$$i", 1]}]}
+                    },
+                    "in": {
+                        "removed": "$$row.removed",
+                        "profit": "$$row.profit",
+                        "snapshots": {"$cond": [
+                            {"$eq": [{"$type": "$$next"}, "missing"]},
+                            {"$subtract": [{"$add": ["$end", 1]}, "$$row.position"]},
+                            {"$max": [1, {"$subtract": ["$$next.position", "$$row.position"]}]}
+                        ]}
+                    }
+                }}
+            }}
+        }},
+        {"$unwind": "$spans"},
+        {"$match": {"spans.removed": False}},
+        {"$group": {
+            "_id": {"$ifNull": ["$name", "Unknown"]},
+            "total_profit": {"$sum": {"$multiply": ["$spans.profit", "$spans.snapshots"]}},
+            "count": {"$sum": "$spans.snapshots"}
+        }},
+        {"$project": {"_id": 0, "user_id": {"$literal": user_id}, "name": "$_id", "total_profit": 1, "count": 1}}
+    ]
+
+async def stored_item_names(user_id: str) -> List[str]:
+    """Every item name in a user's stored snapshots, as item_profits_pipeline names them"""
+    names = set()
+    for field in ("items", "changed_items"):
+        names.update(name for name in await db.price_history.distinct(f"{field}.name", {"user_id": user_id}) if name is not None)
+        if await db.price_history.find_one({"user_id": user_id, field: {"$elemMatch": {"name": None}}}, {"_id": 1}):
+            names.add("Unknown")
+    return list(names)
+
+async def rebuild_analytics_rollup(user_id: str) -> Optional[dict]:
+    """Recompute a user's rollup from their full price history (first use or repair)"""
+    totals = await db.price_history.aggregate(snapshot_totals_pipeline(user_id)).to_list(1)
+    if not totals:
+        return None
+    
+    recent = await db.price_history.find(
+        {"user_id": user_id},
+        {"_id": 0, "snapshot_date": 1, "menu_name": 1, "total_revenue": 1, "total_food_cost": 1, "total_profit": 1}
+    ).sort("snapshot_date", -1).to_list(ANALYTICS_TREND_WINDOW)
+    
+    rollup = {
+        "user_id": user_id,
+        **totals[0],
+        "recent_snapshots": [_trend_entry(snapshot) for snapshot in reversed(recent)],
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    
+    # Item totals are written straight into the rollup collection by Mongo.
+    # Rows are upserted and stale names pruned afterwards (rather than
+    # deleting everything first) so concurrent rebuilds for the same user both succeed.
+    await db.price_history.aggregate(item_profits_pipeline(user_id) + [
+        {"$merge": {
+            "into": "analytics_item_rollups",
+            "on": ["user_id", "name"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ], allowDiskUse=True).to_list(None)
+    await db.analytics_item_rollups.delete_many({"user_id": user_id, "name": {"$nin": await stored_item_names(user_id)}})
+    await db.analytics_rollups.replace_one({"user_id": user_id}, rollup, upsert=True)
+    logger.info(f"Rebuilt analytics rollup for user {user_id} from {rollup['total_snapshots']} snapshots")
+    return rollup
+
+async def apply_snapshot_to_rollup(snapshot: dict, first_for_menu: bool):
+    """Fold a newly written price snapshot into the user's rollup"""
+    result = await db.analytics_rollups.update_one(
+        {"user_id": snapshot["user_id"]},
+        {
+            "$inc": {
+                "total_snapshots": 1,
+                "total_revenue": snapshot.get("total_revenue", 0),
+                "total_food_cost": snapshot.get("total_food_cost", 0),
+                "total_profit": snapshot.get("total_profit", 0),
+                "total_items": snapshot.get("total_items", 0),
+                "total_menus_analyzed": 1 if first_for_menu else 0
+            },
+            "$push": {"recent_snapshots": {"$each": [_trend_entry(snapshot)], "$slice": -ANALYTICS_TREND_WINDOW}},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        }
+    )
+    if not result.matched_count:
+        # No rollup yet: build it from history, which already includes this snapshot
+        await rebuild_analytics_rollup(snapshot["user_id"])
+        return
+    
+    for name, totals in _item_profits([snapshot]).items():
+        await db.analytics_item_rollups.update_one(
+            {"user_id": snapshot["user_id"], "name": name},
+            {"$inc": totals},
+            upsert=True
+        )
+
+async def discard_analytics_rollup(user_id: str):
+    """Delete a rollup that may have missed an update; the next summary rebuilds it"""
+    try:
+        await db.analytics_rollups.delete_one({"user_id": user_id})
+    except Exception as e:
+        logger.error(f"Failed to discard analytics rollup for user {user_id}: {str(e)}")
+
 # ============== PRICE COMPARISON & ANALYTICS ==============
 
 @api_router.get("/analytics/price-history")
 async def get_price_history(user: dict = Depends(get_current_user)):
     """Get all price history snapshots for comparison"""
-    history = await db.price_history.find(
+    reader = read_db("analytics", user)
+    history = await reader.price_history.find(
         {"user_id": user["id"]}, 
         {"_id": 0}
     ).sort("snapshot_date", -1).to_list(100)
-    return history
+    return ORJSONResponse(await expand_snapshots(reader, user["id"], history))
 
 @api_router.get("/analytics/price-history/{menu_id}")
 async def get_menu_price_history(menu_id: str, user: dict = Depends(get_current_user)):
     """Get price history for a specific menu"""
-    history = await db.price_history.find(
+    reader = read_db("analytics", user)
+    history = await reader.price_history.find(
         {"menu_id": menu_id, "user_id": user["id"]}, 
         {"_id": 0}
     ).sort("snapshot_date", -1).to_list(50)
-    return history
+    return ORJSONResponse(await expand_snapshots(reader, user["id"], history))
 
 @api_router.get("/analytics/summary")
 async def get_analytics_summary(user: dict = Depends(get_current_user)):
-    """Get overall analytics summary"""
-    # Get all snapshots
-    history = await db.price_history.find(
-        {"user_id": user["id"]}, 
-        {"_id": 0}
-    ).sort("snapshot_date", 1).to_list(1000)
-    
-    if not history:
+    """Get overall analytics summary from the user's precomputed rollup"""
+    reader = read_db("analytics", user)
+    rollup = await reader.analytics_rollups.find_one({"user_id": user["id"]}, {"_id": 0})
+    if rollup and rollup.get("total_snapshots") != await reader.price_history.count_documents({"user_id": user["id"]}):
+        # An increment was lost, or a rebuild raced an approval and counted a snapshot twice
+        logger.warning(f"Analytics rollup for user {user['id']} is out of step with its price history")
+        rollup = None
+    if not rollup:
+        # The rebuild writes, so it always runs against the primary
+        rollup = await rebuild_analytics_rollup(user["id"])
+    
+    if not rollup:
         return {
             "total_snapshots": 0,
             "total_menus_analyzed": 0,
@@ -959,64 +2637,95 @@ async def get_analytics_summary(user: dict = Depends(get_current_user)):
             "top_performing_items": []
         }
     
-    # Calculate metrics
-    total_profit = sum(h.get("total_profit", 0) for h in history)
-    total_revenue = sum(h.get("total_revenue", 0) for h in history)
-    total_items = sum(h.get("total_items", 0) for h in history)
+    total_revenue = rollup.get("total_revenue", 0)
+    total_profit = rollup.get("total_profit", 0)
     avg_margin = total_profit / total_revenue * 100 if total_revenue > 0 else 0
+    recent = rollup.get("recent_snapshots", [])
     
-    # Get unique menus
-    unique_menus = len(set(h.get("menu_id") for h in history))
-    
-    # Build trend data (last 10 snapshots)
-    recent = history[-10:] if len(history) > 10 else history
-    profit_trend = [
-        {
-            "date": h.get("snapshot_date", "")[:10],
-            "profit": h.get("total_profit", 0),
-            "menu": h.get("menu_name", "")[:20]
-        }
-        for h in recent
-    ]
-    
-    revenue_trend = [
-        {
-            "date": h.get("snapshot_date", "")[:10],
-            "revenue": h.get("total_revenue", 0),
-            "food_cost": h.get("total_food_cost", 0)
-        }
-        for h in recent
-    ]
-    
-    # Find top performing items across all snapshots
-    item_profits = {}
-    for h in history:
-        for item in h.get("items", []):
-            name = item.get("name", "Unknown")
-            profit = item.get("profit", 0)
-            if name in item_profits:
-                item_profits[name]["total_profit"] += profit
-                item_profits[name]["count"] += 1
-            else:
-                item_profits[name] = {"name": name, "total_profit": profit, "count": 1}
-    
-    top_items = sorted(
-        item_profits.values(), 
-        key=lambda x: x["total_profit"], 
-        reverse=True
-    )[:10]
+    top_items = await reader.analytics_item_rollups.find(
+        {"user_id": user["id"]},
+        {"_id": 0, "name": 1, "total_profit": 1, "count": 1}
+    ).sort("total_profit", -1).to_list(ANALYTICS_TOP_ITEMS)
     
     return {
-        "total_snapshots": len(history),
-        "total_menus_analyzed": unique_menus,
-        "total_items_priced": total_items,
+        "total_snapshots": rollup.get("total_snapshots", 0),
+        "total_menus_analyzed": rollup.get("total_menus_analyzed", 0),
+        "total_items_priced": rollup.get("total_items", 0),
         "total_profit_generated": round(total_profit, 2),
         "avg_profit_margin": round(avg_margin, 1),
-        "profit_trend": profit_trend,
-        "revenue_trend": revenue_trend,
+        "profit_trend": [
+            {"date": h["date"], "profit": h["profit"], "menu": h["menu"]}
+            for h in recent
+        ],
+        "revenue_trend": [
+            {"date": h["date"], "revenue": h["revenue"], "food_cost": h["food_cost"]}
+            for h in recent
+        ],
         "top_performing_items": top_items
     }
 
+def _snapshot_scope(snapshot: dict) -> Tuple[dict, dict]:
+    """Query and $expr condition for the stored docs whose rows make up a snapshot's items"""
+    if snapshot.get("encoding") == "delta":
+        return (
+            {"keyframe_id": snapshot["keyframe_id"], "chain_length": {"$lte": snapshot["chain_length"]}},
+            {"$and": [{"$eq": ["$keyframe_id", snapshot["keyframe_id"]]}, {"$lte": ["$chain_length", snapshot["chain_length"]]}]}
+        )
+    return {"id": snapshot["id"]}, {"$eq": ["$id", snapshot["id"]]}
+
+def item_changes_pipeline(user_id: str, first: dict, last: dict) -> List[dict]:
+    """Price and profit change for items present in both snapshots, best profit change first.
+    
+    `first` and `last` are stored snapshot headers; each side's items are
+    replayed from its chain's rows in Mongo.
+    """
+    def side(name):
+        return {"$push": {"$cond": [{"$eq": ["$_id.side", name]}, "$row", "$$REMOVE"]}}
+    
+    first_query, first_in = _snapshot_scope(first)
+    last_query, last_in = _snapshot_scope(last)
+    old_price = {"$ifNull": ["$first.approved_price", 0]}
+    new_price = {"$ifNull": ["$last.approved_price", 0]}
+    return [
+        {"$match": {"user_id": user_id, "$or": [first_query, last_query]}},
+        {"$project": {
+            "_id": 0,
+            "position": {"$ifNull": ["$chain_length", 0]},
+            "sides": {"$concatArrays": [
+                {"$cond": [first_in, ["first"], []]},
+                {"$cond": [last_in, ["last"], []]}
+            ]},
+            "rows": stored_item_rows(["name", "approved_price", "profit"])
+        }},
+        {"$unwind": "$sides"},
+        {"$unwind": {"path": "$rows", "includeArrayIndex": "index"}},
+        {"$sort": {"sides": 1, "position": 1, "index": 1}},
+        # The newest row per name wins (so later duplicates of a name win, as
+        # they did when matching in Python); removed names drop out
+        {"$group": {"_id": {"side": "$sides", "name": "$rows.name"}, "row": {"$last": "$rows"}}},
+        {"$match": {"row.removed": False}},
+        {"$group": {"_id": "$_id.name", "first": side("first"), "last": side("last")}},
+        {"$match": {"first.0": {"$exists": True}, "last.0": {"$exists": True}}},
+        {"$project": {"first": {"$arrayElemAt": ["$first", 0]}, "last": {"$arrayElemAt": ["$last", 0]}}},
+        {"$project": {
+            "_id": 0,
+            "name": "$_id",
+            "old_price": "$first.approved_price",
+            "new_price": "$last.approved_price",
+            "price_change": {"$round": [{"$subtract": [new_price, old_price]}, 2]},
+            "price_change_pct": {"$cond": [
+                {"$eq": [old_price, 0]},
+                0,
+                {"$round": [{"$multiply": [{"$divide": [{"$subtract": [new_price, old_price]}, old_price]}, 100]}, 1]}
+            ]},
+            "profit_change": {"$round": [{"$subtract": [
+                {"$ifNull": ["$last.profit", 0]},
+                {"$ifNull": ["$first.profit", 0]}
+            ]}, 2]}
+        }},
+        {"$sort": {"profit_change": -1}}
+    ]
+
 @api_router.get("/analytics/compare")
 async def compare_snapshots(
     snapshot_ids: str,  # comma-separated IDs
@@ -1025,17 +2734,16 @@ async def compare_snapshots(
     """Compare multiple price snapshots"""
     ids = [id.strip() for id in snapshot_ids.split(",")]
     
-    snapshots = await db.price_history.find(
+    # Snapshot headers only; item matching happens in Mongo below
+    reader = read_db("analytics", user)
+    snapshots = await reader.price_history.find(
         {"id": {"$in": ids}, "user_id": user["id"]},
-        {"_id": 0}
-    ).to_list(10)
+        {"_id": 0, "items": 0, "changed_items": 0, "removed_items": 0}
+    ).sort("snapshot_date", 1).to_list(10)
     
     if len(snapshots) < 2:
         raise HTTPException(status_code=400, detail="Need at least 2 snapshots to compare")
     
-    # Sort by date
-    snapshots.sort(key=lambda x: x.get("snapshot_date", ""))
-    
     # Calculate changes between first and last
     first = snapshots[0]
     last = snapshots[-1]
@@ -1044,27 +2752,14 @@ async def compare_snapshots(
     revenue_change = last.get("total_revenue", 0) - first.get("total_revenue", 0)
     margin_change = last.get("profit_margin", 0) - first.get("profit_margin", 0)
     
-    # Item-level comparison
-    first_items = {i.get("name"): i for i in first.get("items", [])}
-    last_items = {i.get("name"): i for i in last.get("items", [])}
-    
-    item_changes = []
-    for name, last_item in last_items.items():
-        if name in first_items:
-            first_item = first_items[name]
-            price_change = (last_item.get("approved_price", 0) or 0) - (first_item.get("approved_price", 0) or 0)
-            profit_change_item = (last_item.get("profit", 0) or 0) - (first_item.get("profit", 0) or 0)
-            item_changes.append({
-                "name": name,
-                "old_price": first_item.get("approved_price"),
-                "new_price": last_item.get("approved_price"),
-                "price_change": round(price_change, 2),
-                "price_change_pct": round(price_change / first_item.get("approved_price", 1) * 100, 1) if first_item.get("approved_price") else 0,
-                "profit_change": round(profit_change_item, 2)
-            })
+    # Item-level comparison, replayed and matched in Mongo
+    item_changes = await reader.price_history.aggregate(item_changes_pipeline(user["id"], first, last)).to_list(None)
     
     return {
-        "snapshots": snapshots,
+        "snapshots": [
+            {key: value for key, value in snapshot.items() if key not in SNAPSHOT_ENCODING_FIELDS}
+            for snapshot in snapshots
+        ],
         "summary": {
             "period": f"{first.get('snapshot_date', '')[:10]} to {last.get('snapshot_date', '')[:10]}",
             "profit_change": round(profit_change, 2),
@@ -1072,7 +2767,7 @@ async def compare_snapshots(
             "revenue_change": round(revenue_change, 2),
             "margin_change": round(margin_change, 1)
         },
-        "item_changes": sorted(item_changes, key=lambda x: x["profit_change"], reverse=True)
+        "item_changes": item_changes
     }
 
 # ============== PAYMENT ROUTES ==============
@@ -1139,15 +2834,9 @@ async def get_payment_status(session_id: str, user: dict = Depends(get_current_u
     status = await stripe_checkout.get_checkout_status(session_id)
     
     if status.payment_status == "paid" and transaction["status"] != "completed":
-        # Update transaction and add credits
-        await db.payment_transactions.update_one(
-            {"session_id": session_id},
-            {"$set": {"status": "completed", "payment_status": status.payment_status}}
-        )
-        await db.users.update_one(
-            {"id": user["id"]},
-            {"$inc": {"credits": transaction["credits"]}}
-        )
+        # Update transaction and add credits (once, even if the webhook races us)
+        if await complete_transaction(session_id, status.payment_status):
+            await grant_credits(user["id"], transaction["credits"], "purchase", session_id)
         
         return {"status": "completed", "credits_added": transaction["credits"]}
     
@@ -1163,35 +2852,24 @@ async def stripe_webhook(request: Request, stripe_signature: Optional[str] = Hea
         
         if event.payment_status == "paid":
             transaction = await db.payment_transactions.find_one({"session_id": event.session_id})
-            if transaction and transaction["status"] != "completed":
-                await db.payment_transactions.update_one(
-                    {"session_id": event.session_id},
-                    {"$set": {"status": "completed", "payment_status": "paid"}}
-                )
-                
+            if transaction and await complete_transaction(event.session_id, "paid"):
                 # Handle subscription vs one-time purchase
                 if transaction.get("type") == "subscription":
                     # Activate subscription
-                    await db.users.update_one(
-                        {"id": transaction["user_id"]},
+                    await grant_credits(
+                        transaction["user_id"], transaction["credits"], "subscription", event.session_id,
                         {
-                            "$set": {
-                                "subscription": {
-                                    "plan_id": transaction["plan_id"],
-                                    "status": "active",
-                                    "started_at": datetime.now(timezone.utc).isoformat(),
-                                    "next_renewal": (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
-                                }
-                            },
-                            "$inc": {"credits": transaction["credits"]}
+                            "subscription": {
+                                "plan_id": transaction["plan_id"],
+                                "status": "active",
+                                "started_at": datetime.now(timezone.utc).isoformat(),
+                                "next_renewal": (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
+                            }
                         }
                     )
                 else:
                     # One-time credit purchase
-                    await db.users.update_one(
-                        {"id": transaction["user_id"]},
-                        {"$inc": {"credits": transaction["credits"]}}
-                    )
+                    await grant_credits(transaction["user_id"], transaction["credits"], "purchase", event.session_id)
         
         return {"status": "ok"}
     except Exception as e:
@@ -1263,18 +2941,13 @@ async def get_subscription_status(session_id: str, user: dict = Depends(get_curr
     status = await stripe_checkout.get_checkout_status(session_id)
     
     if status.payment_status == "paid" and transaction["status"] != "completed":
-        # Update transaction
-        await db.payment_transactions.update_one(
-            {"session_id": session_id},
-            {"$set": {"status": "completed", "payment_status": status.payment_status}}
-        )
-        
-        # Activate subscription and add credits
+        # Update transaction; activate once, even if the webhook races us
         plan = SUBSCRIPTION_PLANS[transaction["plan_id"]]
-        await db.users.update_one(
-            {"id": user["id"]},
-            {
-                "$set": {
+        if await complete_transaction(session_id, status.payment_status):
+            # Activate subscription and add credits
+            await grant_credits(
+                user["id"], plan.credits_per_month, "subscription", session_id,
+                {
                     "subscription": {
                         "plan_id": transaction["plan_id"],
                         "plan_name": plan.name,
@@ -1283,10 +2956,8 @@ async def get_subscription_status(session_id: str, user: dict = Depends(get_curr
                         "started_at": datetime.now(timezone.utc).isoformat(),
                         "next_renewal": (datetime.now(timezone.utc) + timedelta(days=30)).isoformat()
                     }
-                },
-                "$inc": {"credits": plan.credits_per_month}
-            }
-        )
+                }
+            )
         
         return {
             "status": "completed", 
@@ -1313,6 +2984,7 @@ async def get_current_subscription(user: dict = Depends(get_current_user)):
                     {"id": user["id"]},
                     {"$set": {"subscription.status": "expired"}}
                 )
+                await invalidate_user(user["id"])
     
     return {"subscription": subscription}
 
@@ -1328,105 +3000,521 @@ async def cancel_subscription(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"subscription.status": "cancelled", "subscription.cancelled_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await invalidate_user(user["id"])
     
     return {"message": "Subscription cancelled. You'll retain access until the end of your billing period."}
 
 # ============== EXPORT ROUTES ==============
 
-@api_router.get("/menus/{job_id}/export")
-async def export_menu(job_id: str, format: str = "json", user: dict = Depends(get_current_user)):
-    from fastapi.responses import Response
+EXPORT_PARQUET_BATCH_ROWS = 10000
+
+export_executor = ThreadPoolExecutor(max_workers=EXPORT_THREADS, thread_name_prefix="export")
+
+def export_file_name(name: Optional[str]) -> str:
+    """A menu name made safe for a download filename or archive entry"""
+    name = re.sub(r'[\\/:"\x00-\x1f]', "-", (name or "menu").replace(" ", "_")).replace("..", "_")
+    return name.strip(".")[:50] or "menu"
+
+def menu_items_parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("menu_id", pa.string()),
+        ("menu_name", pa.string()),
+        ("item_id", pa.string()),
+        ("name", pa.string()),
+        ("description", pa.string()),
+        ("current_price", pa.float64()),
+        ("food_cost", pa.float64()),
+        ("food_cost_pct", pa.float64()),
+        ("suggested_price", pa.float64()),
+        ("approved_price", pa.float64()),
+        ("profit_per_plate", pa.float64()),
+        ("price_decision", pa.string()),
+        ("avg_market_price", pa.float64()),
+        ("competitor_count", pa.int32())
+    ])
+
+def price_history_parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("snapshot_id", pa.string()),
+        ("menu_id", pa.string()),
+        ("menu_name", pa.string()),
+        ("snapshot_date", pa.timestamp("us", tz="UTC")),
+        ("name", pa.string()),
+        ("original_price", pa.float64()),
+        ("approved_price", pa.float64()),
+        ("food_cost", pa.float64()),
+        ("profit", pa.float64()),
+        ("decision", pa.string())
+    ])
+
+async def menu_item_rows(job: dict, items):
+    async for item in items:
+        yield {
+            "menu_id": job["id"],
+            "menu_name": job.get("name"),
+            "item_id": item.get("id"),
+            "name": item.get("name"),
+            "description": item.get("description"),
+            "current_price": _optional_float(item.get("current_price")),
+            "food_cost": _optional_float(item.get("food_cost")),
+            "food_cost_pct": _optional_float(item.get("food_cost_pct")),
+            "suggested_price": _optional_float(item.get("suggested_price")),
+            "approved_price": _optional_float(item.get("approved_price")),
+            "profit_per_plate": _optional_float(item.get("profit_per_plate")),
+            "price_decision": item.get("price_decision"),
+            "avg_market_price": _optional_float(item.get("avg_market_price")),
+            "competitor_count": len(item.get("competitor_prices") or [])
+        }
+
+async def price_history_rows(snapshots):
+    async for snapshot in snapshots:
+        snapshot_date = datetime.fromisoformat(snapshot["snapshot_date"]) if snapshot.get("snapshot_date") else None
+        for item in snapshot.get("items", []):
+            yield {
+                "snapshot_id": snapshot["id"],
+                "menu_id": snapshot.get("menu_id"),
+                "menu_name": snapshot.get("menu_name"),
+                "snapshot_date": snapshot_date,
+                "name": item.get("name"),
+                "original_price": _optional_float(item.get("original_price")),
+                "approved_price": _optional_float(item.get("approved_price")),
+                "food_cost": _optional_float(item.get("food_cost")),
+                "profit": _optional_float(item.get("profit")),
+                "decision": item.get("decision")
+            }
+
+def require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet export is not available on this server")
+
+async def stream_parquet(rows, schema):
+    """Parquet file bytes for typed rows, one row group per EXPORT_PARQUET_BATCH_ROWS"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    def write_batch(batch):
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    
+    # Table building and zstd compression run on the export pool
+    loop = asyncio.get_running_loop()
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= EXPORT_PARQUET_BATCH_ROWS:
+            await loop.run_in_executor(export_executor, write_batch, batch)
+            batch = []
+            yield sink.drain()
+    if batch:
+        await loop.run_in_executor(export_executor, write_batch, batch)
+    await loop.run_in_executor(export_executor, writer.close)
+    yield sink.drain()
+
+EXPORT_CSV_HEADER = [
+    "Name", "Description", "Current Price", "Food Cost $", "Food Cost %",
+    "Suggested Price", "Approved Price", "Profit/Plate", "Competitors"
+]
+
+class ExportTotals:
+    """Menu totals accumulated while items stream past"""
     
-    job = await db.menu_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
-    if not job:
-        raise HTTPException(status_code=404, detail="Menu job not found")
+    def __init__(self):
+        self.total_items = 0
+        self.total_food_cost = 0
+        self.total_revenue = 0
+        self.total_profit = 0
     
-    # Add food cost % to each item
-    items = job.get("items", [])
-    for item in items:
+    def add(self, item: dict):
+        self.total_items += 1
+        self.total_food_cost += item.get("food_cost", 0)
+        self.total_revenue += item.get("current_price", 0)
+        self.total_profit += item.get("profit_per_plate", 0)
+    
+    @property
+    def avg_food_cost_pct(self) -> float:
+        return (self.total_food_cost / self.total_revenue * 100) if self.total_revenue > 0 else 0
+    
+    def summary(self) -> dict:
+        return {
+            "total_items": self.total_items,
+            "total_food_cost": round(self.total_food_cost, 2),
+            "total_revenue": round(self.total_revenue, 2),
+            "avg_food_cost_pct": round(self.avg_food_cost_pct, 1)
+        }
+
+class _CSVLine:
+    """File-like target that hands each formatted CSV row straight back"""
+    def write(self, value: str) -> str:
+        return value
+
+async def iter_export_items(reader, job_id: str, user_id: str):
+    """A menu's items one at a time, with food cost % added, without loading the array"""
+    cursor = reader.menu_jobs.aggregate([
+        {"$match": {"id": job_id, "user_id": user_id}},
+        {"$project": {"_id": 0, "items": 1}},
+        {"$unwind": "$items"},
+        {"$replaceRoot": {"newRoot": "$items"}}
+    ], batchSize=200)
+    async for item in cursor:
         current_price = item.get("current_price", 0)
         food_cost = item.get("food_cost", 0)
         if current_price > 0:
             item["food_cost_pct"] = round((food_cost / current_price) * 100, 1)
         else:
             item["food_cost_pct"] = 0
+        yield item
+
+def _json_bytes(value, pretty: bool, level: int = 0) -> bytes:
+    if not pretty:
+        return orjson.dumps(value)
+    return orjson.dumps(value, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n" + b" " * level)
+
+async def stream_json_export(job: dict, items, pretty: bool = False):
+    """The job as JSON with its items and a summary, written item by item"""
+    totals = ExportTotals()
+    newline, indent = (b"\n", b"  ") if pretty else (b"", b"")
+    separator = b": " if pretty else b":"
+    yield b"{" + newline
+    for key, value in job.items():
+        yield indent + orjson.dumps(key) + separator + _json_bytes(value, pretty, 2) + b"," + newline
+    yield indent + b'"items"' + separator + b"["
+    async for item in items:
+        yield (b"," if totals.total_items else b"") + newline + indent * 2 + _json_bytes(item, pretty, 4)
+        totals.add(item)
+    yield (newline + indent if totals.total_items else b"") + b"]," + newline
+    yield indent + b'"summary"' + separator + _json_bytes(totals.summary(), pretty, 2) + newline + b"}" + newline
+
+async def stream_csv_export(items):
+    """CSV rows with food cost %, followed by a totals row from the same pass"""
+    totals = ExportTotals()
+    writer = csv.writer(_CSVLine())
+    # BOM for Excel compatibility
+    yield "\ufeff" + writer.writerow(EXPORT_CSV_HEADER)
+    
+    async for item in items:
+        totals.add(item)
+        # Format competitor info
+        competitors = item.get("competitor_prices", [])
+        competitor_str = "; ".join([
+            f"{c.get('restaurant', 'Unknown')}: ${c.get('price', 0):.2f} ({c.get('distance_miles', 0)}mi)"
+            for c in competitors
+        ]) if competitors else "N/A"
+        
+        yield writer.writerow([
+            item.get("name", ""),
+            item.get("description", ""),
+            f"${item.get('current_price', 0):.2f}",
+            f"${item.get('food_cost', 0):.2f}",
+            f"{item.get('food_cost_pct', 0):.1f}%",
+            f"${item.get('suggested_price', 0):.2f}",
+            f"${item.get('approved_price', 0):.2f}" if item.get('approved_price') else "—",
+            f"${item.get('profit_per_plate', 0):.2f}",
+            competitor_str
+        ])
+    
+    # Add summary row
+    yield writer.writerow([])
+    yield writer.writerow(["TOTALS", "", f"${totals.total_revenue:.2f}", f"${totals.total_food_cost:.2f}",
+                           f"{totals.avg_food_cost_pct:.1f}%", "", "", f"${totals.total_profit:.2f}", ""])
+
+@api_router.get("/menus/{job_id}/export")
+async def export_menu(
+    job_id: str,
+    format: str = "json",
+    pretty: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user)
+):
+    if format not in ("json", "csv", "parquet"):
+        raise HTTPException(status_code=400, detail="Unsupported export format")
+    if format == "parquet":
+        require_pyarrow()
     
-    menu_name = job.get('name', 'menu').replace(' ', '_').replace('/', '-')[:50]
+    reader = read_db("export", user)
+    job = await reader.menu_jobs.find_one(
+        {"id": job_id, "user_id": user["id"]},
+        {"_id": 0, "page_results": 0, "items": 0}
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Menu job not found")
+    
+    # Items are only streamed when the client's copy is out of date
+    etag = menu_etag([(job_id, job.get("updated_at"))], f"export:{format}:{pretty}")
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    
+    menu_name = export_file_name(job.get('name'))
+    items = iter_export_items(reader, job_id, user["id"])
     
     if format == "json":
-        # Include summary data
-        total_food_cost = sum(item.get("food_cost", 0) for item in items)
-        total_revenue = sum(item.get("current_price", 0) for item in items)
-        job["summary"] = {
-            "total_items": len(items),
-            "total_food_cost": round(total_food_cost, 2),
-            "total_revenue": round(total_revenue, 2),
-            "avg_food_cost_pct": round((total_food_cost / total_revenue * 100) if total_revenue > 0 else 0, 1)
-        }
-        
-        # Return as downloadable file
-        json_content = json.dumps(job, indent=2)
-        return Response(
-            content=json_content,
+        return StreamingResponse(
+            stream_json_export(job, items, pretty),
             media_type="application/json",
-            headers={
-                "Content-Disposition": f'attachment; filename="{menu_name}_export.json"'
-            }
+            headers={"Content-Disposition": f'attachment; filename="{menu_name}_export.json"', **etag_headers(etag)}
         )
-    elif format == "csv":
-        # Generate CSV with food cost %
-        import csv
-        import io
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow([
-            "Name", "Description", "Current Price", "Food Cost $", "Food Cost %", 
-            "Suggested Price", "Approved Price", "Profit/Plate", "Competitors"
-        ])
-        
-        for item in items:
-            # Format competitor info
-            competitors = item.get("competitor_prices", [])
-            competitor_str = "; ".join([
-                f"{c.get('restaurant', 'Unknown')}: ${c.get('price', 0):.2f} ({c.get('distance_miles', 0)}mi)"
-                for c in competitors
-            ]) if competitors else "N/A"
-            
-            writer.writerow([
-                item.get("name", ""),
-                item.get("description", ""),
-                f"${item.get('current_price', 0):.2f}",
-                f"${item.get('food_cost', 0):.2f}",
-                f"{item.get('food_cost_pct', 0):.1f}%",
-                f"${item.get('suggested_price', 0):.2f}",
-                f"${item.get('approved_price', 0):.2f}" if item.get('approved_price') else "—",
-                f"${item.get('profit_per_plate', 0):.2f}",
-                competitor_str
-            ])
-        
-        # Add summary row
-        writer.writerow([])
-        total_food_cost = sum(item.get("food_cost", 0) for item in items)
-        total_revenue = sum(item.get("current_price", 0) for item in items)
-        total_profit = sum(item.get("profit_per_plate", 0) for item in items)
-        avg_food_cost_pct = (total_food_cost / total_revenue * 100) if total_revenue > 0 else 0
-        
-        writer.writerow(["TOTALS", "", f"${total_revenue:.2f}", f"${total_food_cost:.2f}", 
-                        f"{avg_food_cost_pct:.1f}%", "", "", f"${total_profit:.2f}", ""])
-        
-        csv_content = output.getvalue()
-        
-        # Return as downloadable file with BOM for Excel compatibility
-        return Response(
-            content="\ufeff" + csv_content,
-            media_type="text/csv; charset=utf-8",
-            headers={
-                "Content-Disposition": f'attachment; filename="{menu_name}_export.csv"'
-            }
+    if format == "parquet":
+        return StreamingResponse(
+            stream_parquet(menu_item_rows(job, items), menu_items_parquet_schema()),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": f'attachment; filename="{menu_name}_items.parquet"', **etag_headers(etag)}
         )
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported export format")
+    
+    return StreamingResponse(
+        stream_csv_export(items),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{menu_name}_export.csv"', **etag_headers(etag)}
+    )
+
+class _StreamSink:
+    """Unseekable file target for zipfile and Parquet writers; written bytes are drained as stream chunks"""
+    
+    closed = False
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0
+    
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+async def stream_zip(entries):
+    """ZIP archive bytes for (name, async text or byte chunks) entries, produced as they are compressed"""
+    loop = asyncio.get_running_loop()
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        async for name, chunks in entries:
+            with archive.open(name, mode="w", force_zip64=True) as entry:
+                # Chunks are gathered here and deflated on the export pool
+                pending = bytearray()
+                async for chunk in chunks:
+                    pending += chunk if isinstance(chunk, bytes) else chunk.encode("utf-8")
+                    if len(pending) >= UPLOAD_CHUNK_SIZE:
+                        await loop.run_in_executor(export_executor, entry.write, bytes(pending))
+                        pending.clear()
+                        yield sink.drain()
+                await loop.run_in_executor(export_executor, entry.write, bytes(pending))
+                await loop.run_in_executor(export_executor, entry.close)
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
+
+async def stream_jsonl(docs):
+    async for doc in docs:
+        yield orjson.dumps(doc) + b"\n"
+
+async def account_export_entries(reader, user_id: str):
+    """Archive entries for every menu (CSV and JSON) and the full price history"""
+    used_names = set()
+    cursor = reader.menu_jobs.find(
+        {"user_id": user_id},
+        {"_id": 0, "page_results": 0, "items": 0}
+    ).sort([("created_at", -1), ("id", -1)])
+    async for job in cursor:
+        menu_name = export_file_name(job.get('name'))
+        if menu_name in used_names:
+            menu_name = f"{menu_name}_{job['id'][:8]}"
+        used_names.add(menu_name)
+        yield f"menus/{menu_name}.csv", stream_csv_export(iter_export_items(reader, job["id"], user_id))
+        yield f"menus/{menu_name}.json", stream_json_export(job, iter_export_items(reader, job["id"], user_id))
+    yield "price_history.jsonl", stream_jsonl(iter_expanded_snapshots(reader, user_id))
+
+@api_router.get("/analytics/export")
+async def export_price_history(user: dict = Depends(get_current_user)):
+    """Every price snapshot item as typed Parquet rows, for warehouse loads"""
+    require_pyarrow()
+    reader = read_db("analytics", user)
+    filename = f"menugenius_price_history_{datetime.now(timezone.utc).strftime('%Y%m%d')}.parquet"
+    return StreamingResponse(
+        stream_parquet(price_history_rows(iter_expanded_snapshots(reader, user["id"])), price_history_parquet_schema()),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.get("/account/export")
+async def export_account(user: dict = Depends(get_current_user)):
+    """Every menu as CSV and JSON plus the price history, streamed as one ZIP"""
+    reader = read_db("export", user)
+    filename = f"menugenius_export_{datetime.now(timezone.utc).strftime('%Y%m%d')}.zip"
+    return StreamingResponse(
+        stream_zip(account_export_entries(reader, user["id"])),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# ============== DATABASE INDEXES ==============
+
+# (collection, keys, options) for every index the hot queries rely on
+INDEXES = [
+    ("users", [("id", ASCENDING)], {"unique": True}),
+    ("users", [("email", ASCENDING)], {"unique": True}),
+    ("menu_jobs", [("id", ASCENDING)], {"unique": True}),
+    ("menu_jobs", [("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], {}),
+    ("menu_jobs", [("status", ASCENDING), ("queued_at", ASCENDING)], {}),
+    ("menu_jobs", [("status", ASCENDING), ("lease_expires_at", ASCENDING)], {}),
+    ("price_history", [("id", ASCENDING)], {"unique": True}),
+    ("price_history", [("user_id", ASCENDING), ("snapshot_date", DESCENDING)], {}),
+    ("price_history", [("menu_id", ASCENDING), ("snapshot_date", DESCENDING)], {}),
+    ("price_history", [("user_id", ASCENDING), ("keyframe_id", ASCENDING), ("snapshot_date", ASCENDING)], {}),
+    ("price_history", [("base_id", ASCENDING)], {"unique": True, "partialFilterExpression": {"base_id": {"$exists": True}}}),
+    ("analytics_rollups", [("user_id", ASCENDING)], {"unique": True}),
+    ("analytics_item_rollups", [("user_id", ASCENDING), ("name", ASCENDING)], {"unique": True}),
+    ("analytics_item_rollups", [("user_id", ASCENDING), ("total_profit", DESCENDING)], {}),
+    ("payment_transactions", [("session_id", ASCENDING)], {"unique": True}),
+    ("credit_ledger", [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    ("credit_ledger", [("ref_id", ASCENDING)], {}),
+    ("extraction_cache", [("key", ASCENDING)], {"unique": True}),
+    ("extraction_cache", [("last_used_at", ASCENDING)], {"expireAfterSeconds": EXTRACTION_CACHE_TTL_SECONDS}),
+]
+
+# Representative shapes of the hot queries, used for explain()
+HOT_QUERIES = [
+    ("auth user lookup", "users", {"id": "probe"}, None),
+    ("login by email", "users", {"email": "probe@example.com"}, None),
+    ("menu by id and owner", "menu_jobs", {"id": "probe", "user_id": "probe"}, None),
+    ("menu listing", "menu_jobs", {"user_id": "probe"}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("analysis queue claim", "menu_jobs", {"status": "pending", "queued_at": {"$ne": None}}, [("queued_at", ASCENDING)]),
+    ("expired analysis leases", "menu_jobs", {"status": "analyzing", "lease_expires_at": {"$lt": "probe"}}, None),
+    ("price history by user", "price_history", {"user_id": "probe"}, [("snapshot_date", DESCENDING)]),
+    ("price history by menu", "price_history", {"menu_id": "probe", "user_id": "probe"}, [("snapshot_date", DESCENDING)]),
+    ("snapshot comparison", "price_history", {"id": {"$in": ["probe"]}, "user_id": "probe"}, None),
+    ("snapshot chain replay", "price_history", {"user_id": "probe", "keyframe_id": {"$in": ["probe"]}}, [("snapshot_date", ASCENDING)]),
+    ("analytics rollup", "analytics_rollups", {"user_id": "probe"}, None),
+    ("top items rollup", "analytics_item_rollups", {"user_id": "probe"}, [("total_profit", DESCENDING)]),
+    ("payment by session", "payment_transactions", {"session_id": "probe"}, None),
+    ("extraction cache lookup", "extraction_cache", {"key": "probe"}, None),
+]
+
+async def ensure_indexes():
+    """Create declared indexes; one failure (e.g. duplicate emails) doesn't block the rest"""
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Failed to create index {collection} {keys}: {str(e)}")
+    logger.info(f"Ensured {len(INDEXES)} indexes")
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+async def explain_hot_queries() -> List[Dict[str, Any]]:
+    report = []
+    for name, collection, query_filter, sort in HOT_QUERIES:
+        command = {"find": collection, "filter": query_filter, "limit": 1}
+        if sort:
+            command["sort"] = dict(sort)
+        explained = await db.command("explain", command, verbosity="queryPlanner")
+        stages = _plan_stages(explained["queryPlanner"]["winningPlan"])
+        report.append({
+            "query": name,
+            "collection": collection,
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages
+        })
+    return report
+
+@api_router.get("/admin/query-plans")
+async def get_query_plans(user: dict = Depends(get_current_user)):
+    """Explain each hot query and flag collection scans (admin only)"""
+    if not user.get("is_admin"):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    report = await explain_hot_queries()
+    return {
+        "queries": report,
+        "collection_scans": [r["query"] for r in report if r["collection_scan"]]
+    }
+
+# ============== METRICS ==============
+
+class LatencyWindow:
+    """Rolling window of recent latency samples (milliseconds)"""
+    
+    def __init__(self, size: int = 1200):
+        self.samples = deque(maxlen=size)
+    
+    def record(self, value_ms: float):
+        self.samples.append((time.time(), value_ms))
+    
+    def summary(self, since: Optional[float] = None) -> Dict[str, Any]:
+        """Percentiles over the window, or only samples taken after `since` (epoch seconds)"""
+        values = [value for ts, value in self.samples if since is None or ts >= since]
+        ordered = sorted(values)
+        if not ordered:
+            return {"samples": 0, "last_ms": 0, "p50_ms": 0, "p99_ms": 0, "max_ms": 0}
+        return {
+            "samples": len(ordered),
+            "last_ms": round(values[-1], 2),
+            "p50_ms": round(ordered[len(ordered) // 2], 2),
+            "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2),
+            "max_ms": round(ordered[-1], 2)
+        }
+
+event_loop_lag = LatencyWindow()
+metrics_counters: Dict[str, int] = defaultdict(int)
+
+async def monitor_event_loop_lag():
+    """Sample how late the loop wakes us up; a blocked loop shows up as lag"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL
+        event_loop_lag.record(max(lag, 0) * 1000)
+
+@api_router.get("/metrics")
+async def get_metrics(since: Optional[float] = None, user: dict = Depends(get_current_user)):
+    """Worker, cache and event-loop counters (admin only)"""
+    if not user.get("is_admin"):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    hits = metrics_counters["extraction_cache_hits"]
+    lookups = hits + metrics_counters["extraction_cache_misses"]
+    return {
+        "llm_backend": llm_backend.name,
+        "event_loop_lag": event_loop_lag.summary(since),
+        "llm": {
+            key: metrics_counters[f"llm_{key}"]
+            for key in ("calls", "retries", "salvaged_items", "prompt_tokens", "output_tokens", "wasted_tokens")
+        },
+        "extraction_cache": {
+            "hits": hits,
+            "misses": metrics_counters["extraction_cache_misses"],
+            "evictions": metrics_counters["extraction_cache_evictions"],
+            "hit_rate": round(hits / lookups, 3) if lookups else 0
+        },
+        "user_cache": {
+            "hits": metrics_counters["user_cache_hits"],
+            "misses": metrics_counters["user_cache_misses"],
+            "size": len(user_cache)
+        }
+    }
 
 # ============== HEALTH CHECK ==============
 
@@ -1449,6 +3537,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_background_tasks():
+    await ensure_indexes()
+    await ensure_user_invalidation_channel()
+    
+    worker_prefix = f"worker-{uuid.uuid4().hex[:8]}"
+    for i in range(ANALYSIS_WORKERS):
+        background_tasks.append(asyncio.create_task(analysis_worker(f"{worker_prefix}-{i}")))
+    background_tasks.append(asyncio.create_task(analysis_reaper()))
+    background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    background_tasks.append(asyncio.create_task(user_invalidation_listener()))
+    logger.info(f"Started {ANALYSIS_WORKERS} analysis worker(s)")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    llm_executor.shutdown(wait=False, cancel_futures=True)
+    password_executor.shutdown(wait=False, cancel_futures=True)
+    media_executor.shutdown(wait=False, cancel_futures=True)
+    export_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
@@ -0,0 +1,680 @@
+"""MenuGenius backend benchmarks
+
+Run from the repository root with the backend's .env / environment in place:
+
+    python backend_benchmark.py normalize --limit 10
+    python backend_benchmark.py load --concurrency 1 4 16 --pages 4
+    python backend_benchmark.py analytics --snapshots 10 1000 50000
+    python backend_benchmark.py login --concurrency 8 32 --logins 200
+    python backend_benchmark.py history --approvals 10000
+    python backend_benchmark.py serialize --items 50 500 5000
+
+`load`, `analytics` and `login` start the real FastAPI app under uvicorn with the fake
+LLM backend (LLM_BACKEND=fake), a scratch database and a scratch upload
+directory, and drive it over HTTP. Everything else talks to the configured
+backend.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+def load_server():
+    """Import the backend module (after any environment overrides are set)"""
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+    return server
+
+def sample_uploads(upload_dir, limit):
+    """Original menu photos in backend/uploads (derived page files are skipped)"""
+    files = sorted(
+        p for p in Path(upload_dir).iterdir()
+        if p.suffix.lower() in IMAGE_EXTENSIONS and "." not in p.stem
+    )
+    return files[:limit]
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+def item_names(items):
+    return {(item.get("name") or "").lower().strip() for item in items or []} - {""}
+
+def synthetic_menu_page(path, seed):
+    """Write a unique menu-like JPEG so extraction-cache hits don't skew results"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (1600, 2200), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(30):
+        draw.text((120, 120 + row * 65), f"Dish {seed}-{row} ........ ${rng.randint(6, 40)}.{rng.randint(0, 99):02d}", fill="black")
+    image.putpixel((0, 0), (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)))
+    image.save(path, format="JPEG", quality=85)
+
+# ============== IMAGE NORMALIZATION ==============
+
+async def bench_normalize(args):
+    """Extraction latency, payload size and item agreement for raw vs normalized pages"""
+    server = load_server()
+    import media
+    files = sample_uploads(server.UPLOAD_DIR, args.limit)
+    if not files:
+        print("No sample images found in backend/uploads")
+        return 1
+
+    rows = []
+    for path in files:
+        raw_started = time.perf_counter()
+        raw_items, _ = await server.extract_page_items(str(path), 0, 1)
+        raw_seconds = time.perf_counter() - raw_started
+
+        norm_started = time.perf_counter()
+        normalized = media.normalize_image(str(path), args.max_edge, args.quality)
+        norm_items, _ = await server.extract_page_items(normalized, 0, 1)
+        norm_seconds = time.perf_counter() - norm_started
+
+        raw_names, norm_names = item_names(raw_items), item_names(norm_items)
+        union = raw_names | norm_names
+        rows.append({
+            "file": path.name,
+            "raw_bytes": path.stat().st_size,
+            "norm_bytes": Path(normalized).stat().st_size,
+            "raw_seconds": raw_seconds,
+            "norm_seconds": norm_seconds,
+            "raw_items": len(raw_items or []),
+            "norm_items": len(norm_items or []),
+            "name_overlap": len(raw_names & norm_names) / len(union) if union else 1.0
+        })
+        row = rows[-1]
+        print(f"{row['file']}: {row['raw_bytes'] / 1024:.0f} KB -> {row['norm_bytes'] / 1024:.0f} KB, "
+              f"{row['raw_seconds']:.2f}s -> {row['norm_seconds']:.2f}s, "
+              f"items {row['raw_items']} -> {row['norm_items']}, overlap {row['name_overlap']:.0%}")
+
+    print("\nSummary")
+    print(f"  pages:              {len(rows)}")
+    print(f"  bytes sent:         {sum(r['raw_bytes'] for r in rows) / 1e6:.1f} MB -> {sum(r['norm_bytes'] for r in rows) / 1e6:.1f} MB")
+    for label, key in (("raw", "raw_seconds"), ("normalized", "norm_seconds")):
+        values = [r[key] for r in rows]
+        print(f"  {label + ' latency:':<20}p50 {statistics.median(values):.2f}s  p99 {percentile(values, 0.99):.2f}s")
+    print(f"  items found:        {sum(r['raw_items'] for r in rows)} -> {sum(r['norm_items'] for r in rows)}")
+    print(f"  mean name overlap:  {statistics.mean(r['name_overlap'] for r in rows):.0%}")
+    return 0
+
+# ============== APP UNDER TEST ==============
+
+class BenchmarkApp:
+    """The real FastAPI app in a uvicorn subprocess, backed by a scratch database"""
+
+    def __init__(self, port, env):
+        self.port = port
+        self.base_url = f"http://127.0.0.1:{port}/api"
+        self.env = env
+        self.upload_dir = tempfile.TemporaryDirectory(prefix="menugenius-bench-")
+        self.process = None
+
+    async def __aenter__(self):
+        from pymongo import MongoClient
+
+        env = {
+            **os.environ,
+            "DB_NAME": "menugenius_benchmark",
+            "UPLOAD_DIR": self.upload_dir.name,
+            "LLM_BACKEND": "fake",
+            "ANALYSIS_POLL_INTERVAL": "0.5",
+            **self.env
+        }
+        MongoClient(env.get("MONGO_URL", "mongodb://localhost:27017")).drop_database(env["DB_NAME"])
+
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--port", str(self.port), "--log-level", "warning"],
+            cwd=BACKEND_DIR,
+            env=env
+        )
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    if (await client.get(f"{self.base_url}/health")).status_code == 200:
+                        return self
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError("Benchmark app did not start")
+
+    async def __aexit__(self, *exc):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+        self.upload_dir.cleanup()
+
+async def admin_headers(client, base_url):
+    response = await client.get(f"{base_url}/auth/admin-login")
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def probe_latency(client, url, stop, samples, interval=0.05, headers=None):
+    """Time an unrelated endpoint until `stop` is set"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await client.get(url, headers=headers)
+        samples.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(interval)
+
+# ============== ANALYSIS PIPELINE LOAD ==============
+
+async def run_analysis_client(client, base_url, headers, page_dir, client_idx, menus, pages, job_latencies):
+    for menu_idx in range(menus):
+        files = []
+        for page in range(pages):
+            path = Path(page_dir) / f"c{client_idx}-m{menu_idx}-p{page}-{time.time_ns()}.jpg"
+            synthetic_menu_page(path, f"{client_idx}-{menu_idx}-{page}-{time.time_ns()}")
+            files.append(("files", (path.name, path.read_bytes(), "image/jpeg")))
+
+        response = await client.post(f"{base_url}/menus/upload", files=files, headers=headers)
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+
+        started = time.perf_counter()
+        (await client.post(f"{base_url}/menus/{job_id}/analyze", headers=headers)).raise_for_status()
+        while True:
+            job = (await client.get(f"{base_url}/menus/{job_id}", headers=headers)).json()
+            if job["status"] == "completed" or job.get("analysis_error"):
+                break
+            await asyncio.sleep(0.25)
+        job_latencies.append(time.perf_counter() - started)
+
+async def bench_load(args):
+    """Pages/sec, job latency and event-loop lag at increasing client concurrency"""
+    env = {
+        "ANALYSIS_WORKERS": str(args.workers),
+        "LLM_FAKE_LATENCY_MS": str(args.latency_ms),
+        "LLM_FAKE_JITTER_MS": str(args.jitter_ms),
+        "LLM_FAKE_ERROR_RATE": str(args.error_rate),
+        "LLM_FAKE_TRUNCATE_RATE": str(args.truncate_rate),
+        "EVENT_LOOP_LAG_INTERVAL": "0.05"
+    }
+    if args.recordings:
+        env["LLM_FAKE_RECORDINGS"] = str(Path(args.recordings).resolve())
+
+    rows = []
+    async with BenchmarkApp(args.port, env) as app:
+        async with httpx.AsyncClient(timeout=120) as client:
+            headers = await admin_headers(client, app.base_url)
+            with tempfile.TemporaryDirectory(prefix="menugenius-pages-") as page_dir:
+                for concurrency in args.concurrency:
+                    job_latencies, health_ms = [], []
+                    stop = asyncio.Event()
+                    probe = asyncio.create_task(probe_latency(client, f"{app.base_url}/health", stop, health_ms))
+                    level_start = time.time()
+                    started = time.perf_counter()
+
+                    await asyncio.gather(*(
+                        run_analysis_client(client, app.base_url, headers, page_dir, i, args.menus, args.pages, job_latencies)
+                        for i in range(concurrency)
+                    ))
+
+                    elapsed = time.perf_counter() - started
+                    stop.set()
+                    await probe
+                    metrics = (await client.get(f"{app.base_url}/metrics", params={"since": level_start}, headers=headers)).json()
+                    rows.append({
+                        "concurrency": concurrency,
+                        "pages_per_sec": concurrency * args.menus * args.pages / elapsed,
+                        "job_p50": statistics.median(job_latencies),
+                        "job_p99": percentile(job_latencies, 0.99),
+                        "lag_p99": metrics["event_loop_lag"]["p99_ms"],
+                        "lag_max": metrics["event_loop_lag"]["max_ms"],
+                        "health_p99": percentile(health_ms, 0.99)
+                    })
+                    print(f"concurrency {concurrency}: done in {elapsed:.1f}s")
+
+    print(f"\n{'clients':>8} {'pages/s':>9} {'job p50':>9} {'job p99':>9} {'lag p99':>9} {'lag max':>9} {'health p99':>11}")
+    for r in rows:
+        print(f"{r['concurrency']:>8} {r['pages_per_sec']:>9.2f} {r['job_p50']:>8.2f}s {r['job_p99']:>8.2f}s "
+              f"{r['lag_p99']:>7.1f}ms {r['lag_max']:>7.1f}ms {r['health_p99']:>9.1f}ms")
+    return 0
+
+# ============== ANALYTICS AGGREGATION ==============
+
+def seed_snapshots(collection, user_id, count, items_per_snapshot, seed, encode=None):
+    """Insert `count` synthetic price snapshots for one user
+
+    Snapshots rotate over 25 menus and each approval changes a few prices.
+    With `encode` (server.encode_snapshot) they are stored the way the app
+    stores them, as keyframes and deltas; without it every one is a full
+    pre-delta document.
+    """
+    from datetime import datetime, timedelta, timezone
+
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    menus = {}
+    batch = []
+    for n in range(count):
+        menu_id = f"{user_id}-menu-{n % 25}"
+        items, previous = menus.get(menu_id, (None, None))
+        if items is None:
+            items = []
+            for i in range(items_per_snapshot):
+                price = round(rng.uniform(8, 40), 2)
+                food_cost = round(price * rng.uniform(0.2, 0.4), 2)
+                items.append({
+                    "name": f"Dish {i}",
+                    "original_price": price,
+                    "approved_price": price,
+                    "food_cost": food_cost,
+                    "profit": round(price - food_cost, 2),
+                    "decision": "maintain"
+                })
+        else:
+            items = [dict(item) for item in items]
+            for item in rng.sample(items, min(len(items), rng.randint(1, 3))):
+                item["approved_price"] = round(item["approved_price"] + rng.choice([-0.5, 0.25, 0.5, 1.0]), 2)
+                item["profit"] = round(item["approved_price"] - item["food_cost"], 2)
+                item["decision"] = "custom"
+        revenue = sum(item["approved_price"] for item in items)
+        profit = sum(item["profit"] for item in items)
+        snapshot = {
+            "id": f"{user_id}-{n}",
+            "menu_id": menu_id,
+            "user_id": user_id,
+            "menu_name": f"Menu {n % 25}",
+            "snapshot_date": (start + timedelta(minutes=n)).isoformat(),
+            "total_items": len(items),
+            "total_revenue": round(revenue, 2),
+            "total_food_cost": round(revenue - profit, 2),
+            "total_profit": round(profit, 2),
+            "profit_margin": round(profit / revenue * 100, 1),
+            "items": items
+        }
+        if encode:
+            doc = encode(snapshot, previous)
+            previous = {"id": doc["id"], "keyframe_id": doc["keyframe_id"], "chain_length": doc["chain_length"], "items": items}
+        else:
+            doc = snapshot
+        menus[menu_id] = (items, previous)
+        batch.append(doc)
+        if len(batch) == 1000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+def timed_read(run):
+    """Seconds and BSON bytes moved from Mongo for a cursor-returning callable"""
+    started = time.perf_counter()
+    docs = list(run())
+    return time.perf_counter() - started, sum(len(doc.raw) for doc in docs), docs
+
+def python_top_items(docs):
+    """The pre-pipeline approach: aggregate every snapshot's items in Python"""
+    item_profits = {}
+    for doc in docs:
+        for item in doc.get("items", []):
+            entry = item_profits.setdefault(item.get("name", "Unknown"), {"total_profit": 0, "count": 0})
+            entry["total_profit"] += item.get("profit", 0)
+            entry["count"] += 1
+    return sorted(item_profits.items(), key=lambda x: x[1]["total_profit"], reverse=True)[:10]
+
+async def timed_get(client, url, headers, params=None):
+    started = time.perf_counter()
+    response = await client.get(url, headers=headers, params=params)
+    response.raise_for_status()
+    return time.perf_counter() - started, len(response.content)
+
+async def bench_analytics(args):
+    """Latency and bytes transferred for analytics reads as snapshot history grows"""
+    import bson
+    from bson.raw_bson import RawBSONDocument
+    from pymongo import MongoClient
+
+    server = load_server()
+    rows = []
+    async with BenchmarkApp(args.port, {}) as app:
+        mongo = MongoClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), document_class=RawBSONDocument)
+        database = mongo["menugenius_benchmark"]
+        async with httpx.AsyncClient(timeout=600) as client:
+            for count in args.snapshots:
+                response = await client.post(f"{app.base_url}/auth/register", json={
+                    "email": f"analytics-{count}-{time.time_ns()}@example.com",
+                    "password": "benchmark",
+                    "name": f"Analytics {count}"
+                })
+                response.raise_for_status()
+                user_id = response.json()["user"]["id"]
+                headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+                seed_started = time.perf_counter()
+                encode = server.encode_snapshot if args.encoding == "delta" else None
+                seed_snapshots(database.price_history, user_id, count, args.items, count, encode)
+                print(f"{count} snapshots ({args.encoding}): seeded in {time.perf_counter() - seed_started:.1f}s")
+
+                python_seconds, python_bytes, docs = timed_read(
+                    lambda: database.price_history.find({"user_id": user_id}, {"_id": 0}).sort("snapshot_date", 1)
+                )
+                python_started = time.perf_counter()
+                if encode:
+                    # Deltas only carry changed items, so chains are replayed as the app does
+                    docs = [bson.decode(doc.raw) for doc in docs]
+                    states = server.replay_snapshot_chains(docs)
+                    docs = [{"items": states[doc["id"]]} for doc in docs]
+                python_top_items(docs)
+                python_seconds += time.perf_counter() - python_started
+                del docs
+
+                pipeline_seconds, pipeline_bytes, _ = timed_read(
+                    lambda: database.price_history.aggregate(
+                        server.item_profits_pipeline(user_id) + [{"$sort": {"total_profit": -1}}, {"$limit": 10}]
+                    )
+                )
+
+                database.analytics_rollups.delete_one({"user_id": user_id})
+                cold_seconds, _ = await timed_get(client, f"{app.base_url}/analytics/summary", headers)
+                warm = [await timed_get(client, f"{app.base_url}/analytics/summary", headers) for _ in range(args.repeat)]
+                compare = [
+                    await timed_get(client, f"{app.base_url}/analytics/compare", headers,
+                                    {"snapshot_ids": f"{user_id}-0,{user_id}-{count - 1}"})
+                    for _ in range(args.repeat)
+                ]
+                rows.append({
+                    "snapshots": count,
+                    "python_ms": python_seconds * 1000,
+                    "python_kb": python_bytes / 1024,
+                    "pipeline_ms": pipeline_seconds * 1000,
+                    "pipeline_kb": pipeline_bytes / 1024,
+                    "rebuild_ms": cold_seconds * 1000,
+                    "summary_ms": statistics.median(s for s, _ in warm) * 1000,
+                    "summary_kb": warm[0][1] / 1024,
+                    "compare_ms": statistics.median(s for s, _ in compare) * 1000,
+                    "compare_kb": compare[0][1] / 1024
+                })
+        mongo.close()
+
+    print(f"\n{'snapshots':>10} {'py items':>16} {'pipeline':>16} {'rebuild':>9} {'summary':>16} {'compare':>16}")
+    for r in rows:
+        print(f"{r['snapshots']:>10} "
+              f"{r['python_ms']:>7.0f}ms {r['python_kb']:>6.0f}KB "
+              f"{r['pipeline_ms']:>7.1f}ms {r['pipeline_kb']:>6.1f}KB "
+              f"{r['rebuild_ms']:>7.0f}ms "
+              f"{r['summary_ms']:>7.1f}ms {r['summary_kb']:>6.1f}KB "
+              f"{r['compare_ms']:>7.1f}ms {r['compare_kb']:>6.1f}KB")
+    print("\npy items/pipeline: Mongo read + top-item aggregation in Python vs in an aggregation pipeline")
+    print("with --encoding delta, py items includes chain replay and the pipeline works on the stored deltas")
+    print("rebuild: first summary request (rollup rebuilt); summary/compare: median HTTP latency and response size")
+    return 0
+
+# ============== LOGIN BURST ==============
+
+async def run_login_client(client, base_url, email, password, logins, latencies):
+    for _ in range(logins):
+        started = time.perf_counter()
+        response = await client.post(f"{base_url}/auth/login", json={"email": email, "password": password})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+
+async def bench_login(args):
+    """Logins/sec and latency of unrelated endpoints during a login burst"""
+    rows = []
+    env = {
+        "BCRYPT_ROUNDS": str(args.rounds),
+        "PASSWORD_HASH_THREADS": str(args.threads),
+        "EVENT_LOOP_LAG_INTERVAL": "0.05"
+    }
+    async with BenchmarkApp(args.port, env) as app:
+        async with httpx.AsyncClient(timeout=120) as client:
+            email, password = f"login-{time.time_ns()}@example.com", "benchmark-password"
+            response = await client.post(f"{app.base_url}/auth/register", json={
+                "email": email, "password": password, "name": "Login Benchmark"
+            })
+            response.raise_for_status()
+            headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+            metrics_headers = await admin_headers(client, app.base_url)
+
+            for concurrency in args.concurrency:
+                login_latencies, health_ms, menus_ms = [], [], []
+                stop = asyncio.Event()
+                probes = [
+                    asyncio.create_task(probe_latency(client, f"{app.base_url}/health", stop, health_ms)),
+                    asyncio.create_task(probe_latency(client, f"{app.base_url}/menus", stop, menus_ms, headers=headers))
+                ]
+                level_start = time.time()
+                started = time.perf_counter()
+
+                await asyncio.gather(*(
+                    run_login_client(client, app.base_url, email, password, args.logins // concurrency, login_latencies)
+                    for _ in range(concurrency)
+                ))
+
+                elapsed = time.perf_counter() - started
+                stop.set()
+                await asyncio.gather(*probes)
+                metrics = (await client.get(f"{app.base_url}/metrics", params={"since": level_start}, headers=metrics_headers)).json()
+                rows.append({
+                    "concurrency": concurrency,
+                    "logins_per_sec": len(login_latencies) / elapsed,
+                    "login_p99": percentile(login_latencies, 0.99) * 1000,
+                    "health_p99": percentile(health_ms, 0.99),
+                    "menus_p99": percentile(menus_ms, 0.99),
+                    "lag_max": metrics["event_loop_lag"]["max_ms"]
+                })
+                print(f"concurrency {concurrency}: {len(login_latencies)} logins in {elapsed:.1f}s")
+
+    print(f"\nbcrypt rounds {args.rounds}, {args.threads} hashing thread(s)")
+    print(f"{'clients':>8} {'logins/s':>9} {'login p99':>10} {'health p99':>11} {'menus p99':>10} {'lag max':>9}")
+    for r in rows:
+        print(f"{r['concurrency']:>8} {r['logins_per_sec']:>9.1f} {r['login_p99']:>8.0f}ms "
+              f"{r['health_p99']:>9.1f}ms {r['menus_p99']:>8.1f}ms {r['lag_max']:>7.1f}ms")
+    return 0
+
+# ============== PRICE HISTORY STORAGE ==============
+
+async def bench_history(args):
+    """BSON storage for full vs delta-encoded price snapshots over a synthetic approval history"""
+    import bson
+
+    server = load_server()
+    rng = random.Random(args.seed)
+    items = [
+        {"name": f"Dish {i}", "original_price": 12.0, "approved_price": 12.0, "food_cost": 4.0, "profit": 8.0, "decision": "maintain"}
+        for i in range(args.items)
+    ]
+    previous, docs, chain, truth = None, [], [], {}
+    full_bytes = encoded_bytes = 0
+    keyframes = 0
+
+    for n in range(args.approvals):
+        items = [dict(item) for item in items]
+        for item in rng.sample(items, rng.randint(1, args.max_changes)):
+            item["approved_price"] = round(item["approved_price"] + rng.choice([-0.5, 0.25, 0.5, 1.0]), 2)
+            item["profit"] = round(item["approved_price"] - item["food_cost"], 2)
+            item["decision"] = "custom"
+        snapshot = {
+            "id": f"snapshot-{n}",
+            "menu_id": "menu",
+            "user_id": "user",
+            "menu_name": "Benchmark Menu",
+            "snapshot_date": f"2024-01-01T00:00:00.{n:06d}+00:00",
+            "total_items": len(items),
+            "total_revenue": round(sum(item["approved_price"] for item in items), 2),
+            "total_food_cost": round(sum(item["food_cost"] for item in items), 2),
+            "total_profit": round(sum(item["profit"] for item in items), 2),
+            "profit_margin": 0,
+            "items": items
+        }
+        doc = server.encode_snapshot(snapshot, previous)
+        full_bytes += len(bson.encode(snapshot))
+        encoded_bytes += len(bson.encode(doc))
+        keyframes += doc["encoding"] == "keyframe"
+        docs.append(doc)
+        truth[snapshot["id"]] = items
+
+        chain = [doc] if doc["encoding"] == "keyframe" else chain + [doc]
+        state_items = server.replay_snapshot_chains(chain)[doc["id"]]
+        previous = {"id": doc["id"], "keyframe_id": doc["keyframe_id"], "chain_length": doc["chain_length"], "items": state_items}
+
+    started = time.perf_counter()
+    states = server.replay_snapshot_chains(docs)
+    replay_seconds = time.perf_counter() - started
+    mismatches = sum(
+        sorted(map(repr, states[snapshot_id])) != sorted(map(repr, expected))
+        for snapshot_id, expected in truth.items()
+    )
+
+    print(f"approvals:          {args.approvals} ({args.items} items, 1-{args.max_changes} price changes each)")
+    print(f"keyframe interval:  {server.PRICE_HISTORY_KEYFRAME_INTERVAL} ({keyframes} keyframes)")
+    print(f"full snapshots:     {full_bytes / 1e6:.2f} MB")
+    print(f"delta encoded:      {encoded_bytes / 1e6:.2f} MB ({1 - encoded_bytes / full_bytes:.0%} smaller)")
+    print(f"full replay:        {replay_seconds * 1000:.0f} ms for every snapshot")
+    print(f"reconstruction:     {'exact' if not mismatches else f'{mismatches} mismatched snapshots'}")
+    return 1 if mismatches else 0
+
+# ============== JSON SERIALIZATION ==============
+
+def synthetic_menu(item_count, seed=0):
+    """A fully analyzed menu document shaped like menu_jobs entries"""
+    rng = random.Random(seed)
+    items = []
+    for i in range(item_count):
+        price = round(rng.uniform(8, 40), 2)
+        items.append({
+            "id": f"item-{i:05d}",
+            "name": f"Dish {i}",
+            "description": "Slow-braised with seasonal vegetables and house sauce",
+            "current_price": price,
+            "suggested_price": round(price * 1.08, 2),
+            "approved_price": None,
+            "food_cost": round(price * 0.3, 2),
+            "food_cost_pct": 30.0,
+            "profit_per_plate": round(price * 0.7, 2),
+            "price_decision": None,
+            "ingredients": [
+                {"name": f"Ingredient {j}", "portion": "4 oz", "estimated_cost": round(rng.uniform(0.2, 3), 2)}
+                for j in range(6)
+            ],
+            "competitor_prices": [
+                {"restaurant": f"Competitor {j}", "price": round(price * rng.uniform(0.8, 1.2), 2), "distance_miles": round(rng.uniform(0.1, 5), 1)}
+                for j in range(3)
+            ],
+            "avg_market_price": price,
+            "market_price_range": {"min": price * 0.8, "max": price * 1.2}
+        })
+    return {
+        "id": "benchmark-menu",
+        "user_id": "benchmark-user",
+        "name": "Benchmark Menu",
+        "status": "completed",
+        "items": items,
+        "total_food_cost": sum(item["food_cost"] for item in items),
+        "total_profit": sum(item["profit_per_plate"] for item in items),
+        "location": "New York",
+        "created_at": "2024-01-01T00:00:00+00:00",
+        "updated_at": "2024-01-01T00:00:00+00:00"
+    }
+
+def best_of(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = run()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000, len(output)
+
+async def bench_serialize(args):
+    """Serialization time and bytes for API responses and exports at several menu sizes"""
+    import json
+
+    import orjson
+    from fastapi.encoders import jsonable_encoder
+
+    variants = [
+        # What JSONResponse did for every route before
+        ("stdlib JSONResponse", lambda doc: json.dumps(
+            jsonable_encoder(doc), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")),
+        # ORJSONResponse as the default class (FastAPI still runs jsonable_encoder)
+        ("ORJSONResponse default", lambda doc: orjson.dumps(jsonable_encoder(doc))),
+        # Routes that return ORJSONResponse themselves
+        ("ORJSONResponse direct", lambda doc: orjson.dumps(doc)),
+        ("export stdlib indent=2", lambda doc: json.dumps(doc, indent=2).encode("utf-8")),
+        ("export orjson pretty", lambda doc: orjson.dumps(doc, option=orjson.OPT_INDENT_2)),
+        ("export orjson compact", lambda doc: orjson.dumps(doc))
+    ]
+
+    print(f"{'items':>6} {'variant':<24} {'time':>10} {'bytes':>12}")
+    for item_count in args.items:
+        doc = synthetic_menu(item_count)
+        for label, serialize in variants:
+            milliseconds, size = best_of(lambda: serialize(doc), args.repeat)
+            print(f"{item_count:>6} {label:<24} {milliseconds:>8.2f}ms {size:>12,}")
+        print()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="MenuGenius backend benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    normalize = subparsers.add_parser("normalize", help="Raw vs normalized page extraction")
+    normalize.add_argument("--limit", type=int, default=10)
+    normalize.add_argument("--max-edge", type=int, default=2048)
+    normalize.add_argument("--quality", type=int, default=85)
+    normalize.set_defaults(run=bench_normalize)
+
+    load = subparsers.add_parser("load", help="Analysis pipeline under load against the fake LLM backend")
+    load.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    load.add_argument("--menus", type=int, default=2, help="Menus analyzed per client")
+    load.add_argument("--pages", type=int, default=4, help="Pages per menu")
+    load.add_argument("--workers", type=int, default=4, help="ANALYSIS_WORKERS for the app")
+    load.add_argument("--latency-ms", type=float, default=1500)
+    load.add_argument("--jitter-ms", type=float, default=500)
+    load.add_argument("--error-rate", type=float, default=0.0)
+    load.add_argument("--truncate-rate", type=float, default=0.0)
+    load.add_argument("--recordings", help="JSONL written with LLM_RECORD_PATH")
+    load.add_argument("--port", type=int, default=8765)
+    load.set_defaults(run=bench_load)
+
+    analytics = subparsers.add_parser("analytics", help="Analytics summary and comparison as snapshot history grows")
+    analytics.add_argument("--snapshots", type=int, nargs="+", default=[10, 1000, 50000], help="Snapshots per user")
+    analytics.add_argument("--items", type=int, default=20, help="Items per snapshot")
+    analytics.add_argument("--repeat", type=int, default=5)
+    analytics.add_argument("--encoding", choices=["delta", "full"], default="delta",
+                           help="Store history as the app does (keyframes and deltas) or as full snapshots")
+    analytics.add_argument("--port", type=int, default=8765)
+    analytics.set_defaults(run=bench_analytics)
+
+    login = subparsers.add_parser("login", help="Login burst throughput and its effect on other endpoints")
+    login.add_argument("--concurrency", type=int, nargs="+", default=[8, 32])
+    login.add_argument("--logins", type=int, default=200, help="Logins per concurrency level")
+    login.add_argument("--rounds", type=int, default=12, help="BCRYPT_ROUNDS for the app")
+    login.add_argument("--threads", type=int, default=2, help="PASSWORD_HASH_THREADS for the app")
+    login.add_argument("--port", type=int, default=8765)
+    login.set_defaults(run=bench_login)
+
+    history = subparsers.add_parser("history", help="Storage of full vs delta-encoded price history")
+    history.add_argument("--approvals", type=int, default=10000)
+    history.add_argument("--items", type=int, default=40, help="Items per menu")
+    history.add_argument("--max-changes", type=int, default=3, help="Most prices changed per approval")
+    history.add_argument("--seed", type=int, default=1)
+    history.set_defaults(run=bench_history)
+
+    serialize = subparsers.add_parser("serialize", help="JSON serialization time and size by menu size")
+    serialize.add_argument("--items", type=int, nargs="+", default=[50, 500, 5000], help="Items per menu")
+    serialize.add_argument("--repeat", type=int, default=20)
+    serialize.set_defaults(run=bench_serialize)
+
+    args = parser.parse_args()
+    return asyncio.run(args.run(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -257,7 +257,7 @@ class MenuGeniusAPITester:
     def test_get_menus(self):
         """Test getting user menus"""
         response = self.run_test("Get User Menus", "GET", "menus", 200)
-        return isinstance(response, list)
+        return isinstance(response, dict) and isinstance(response.get("menus"), list)
 
     def test_invalid_endpoints(self):
         """Test invalid endpoints return 404"""
@@ -4,3 +4,20 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+// Analysis runs in a background worker; poll the job until it leaves the queue.
+export async function waitForAnalysis(fetchJob, { interval = 2000, timeout = 600000 } = {}) {
+  const deadline = Date.now() + timeout;
+  while (Date.now() < deadline) {
+    const job = await fetchJob();
+    if (job.status === "analyzing" || (job.status === "pending" && job.queued_at)) {
+      await new Promise((resolve) => setTimeout(resolve, interval));
+      continue;
+    }
+    if (job.analysis_error) {
+      throw new Error(job.analysis_error);
+    }
+    return job;
+  }
+  throw new Error("Analysis is taking longer than expected");
+}
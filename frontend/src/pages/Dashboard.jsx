@@ -42,13 +42,14 @@ export default function Dashboard() {
   const fetchMenus = async () => {
     try {
       const response = await axios.get(`${API}/menus`, {
-        headers: { Authorization: `Bearer ${token}` }
+        headers: { Authorization: `Bearer ${token}` },
+        params: { limit: 100 }
       });
-      const menus = response.data;
+      const menus = response.data.menus;
       setRecentMenus(menus.slice(0, 5));
       
       // Calculate stats
-      const totalItems = menus.reduce((acc, m) => acc + (m.items?.length || 0), 0);
+      const totalItems = menus.reduce((acc, m) => acc + (m.item_count || 0), 0);
       const totalProfit = menus.reduce((acc, m) => acc + (m.total_profit || 0), 0);
       setStats({
         totalMenus: menus.length,
@@ -322,7 +323,7 @@ export default function Dashboard() {
                       <div>
                         <h3 className="font-medium text-white">{menu.name}</h3>
                         <p className="text-sm text-zinc-500">
-                          {menu.items?.length || 0} items • {new Date(menu.created_at).toLocaleDateString()}
+                          {menu.item_count || 0} items • {new Date(menu.created_at).toLocaleDateString()}
                         </p>
                       </div>
                     </div>
@@ -15,6 +15,7 @@ import {
   SelectValue,
 } from "../components/ui/select";
 import { useAuth, API } from "../App";
+import { waitForAnalysis } from "../lib/utils";
 import { toast } from "sonner";
 import {
   ChefHat,
@@ -93,10 +94,16 @@ export default function MenuAnalysis() {
       await axios.post(`${API}/menus/${jobId}/analyze`, {}, {
         headers: { Authorization: `Bearer ${token}` }
       });
+      await waitForAnalysis(async () => {
+        const response = await axios.get(`${API}/menus/${jobId}`, {
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        return response.data;
+      });
       toast.success("Re-analysis complete!");
       fetchMenu();
     } catch (error) {
-      toast.error(error.response?.data?.detail || "Analysis failed");
+      toast.error(error.response?.data?.detail || error.message || "Analysis failed");
     } finally {
       setAnalyzing(false);
     }
@@ -7,6 +7,7 @@ import { Input } from "../components/ui/input";
 import { Label } from "../components/ui/label";
 import { Card, CardContent } from "../components/ui/card";
 import { useAuth, API } from "../App";
+import { waitForAnalysis } from "../lib/utils";
 import { toast } from "sonner";
 import AddressSearch from "../components/AddressSearch";
 import {
@@ -198,14 +199,19 @@ export default function MenuUpload() {
 
     try {
       await axios.post(`${API}/menus/${jobId}/analyze`, {}, {
-        headers: { Authorization: `Bearer ${token}` },
-        timeout: 120000 // 2 minute timeout for analysis
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      await waitForAnalysis(async () => {
+        const response = await axios.get(`${API}/menus/${jobId}`, {
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        return response.data;
       });
 
       toast.success("Analysis complete!");
       navigate(`/menu/${jobId}`);
     } catch (error) {
-      const message = error.response?.data?.detail || "Analysis failed";
+      const message = error.response?.data?.detail || error.message || "Analysis failed";
       toast.error(message);
       // Still navigate to view partial results
       navigate(`/menu/${jobId}`);
@@ -55,10 +55,18 @@ export default function SavedMenus() {
 
   const fetchMenus = async () => {
     try {
-      const response = await axios.get(`${API}/menus`, {
-        headers: { Authorization: `Bearer ${token}` }
-      });
-      setMenus(response.data);
+      // Summaries are small, so page through the whole list for search and filters
+      const allMenus = [];
+      let cursor = null;
+      do {
+        const response = await axios.get(`${API}/menus`, {
+          headers: { Authorization: `Bearer ${token}` },
+          params: { limit: 100, ...(cursor && { cursor }) }
+        });
+        allMenus.push(...response.data.menus);
+        cursor = response.data.next_cursor;
+      } while (cursor);
+      setMenus(allMenus);
     } catch (error) {
       toast.error("Failed to load menus");
     } finally {
@@ -243,7 +251,7 @@ export default function SavedMenus() {
                               <Calendar className="w-4 h-4" />
                               {new Date(menu.created_at).toLocaleDateString()}
                             </span>
-                            <span>{menu.items?.length || 0} items</span>
+                            <span>{menu.item_count || 0} items</span>
                             {menu.location && (
                               <span className="flex items-center gap-1">
                                 📍 {menu.location}
@@ -0,0 +1,111 @@
+import copy
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# server.py lives in backend/ and is imported as a top-level module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from pymongo import ReturnDocument
+
+
+def matches(doc, query):
+    """The subset of Mongo query matching the server's hot paths use"""
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict) and any(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+                if op == "$gte" and (value is None or value < operand):
+                    return False
+                if op == "$lt" and (value is None or value >= operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def apply_update(doc, update):
+    for key, value in update.get("$set", {}).items():
+        doc[key] = copy.deepcopy(value)
+    for key, value in update.get("$inc", {}).items():
+        doc[key] = doc.get(key, 0) + value
+    for key, value in update.get("$push", {}).items():
+        doc.setdefault(key, []).append(copy.deepcopy(value))
+
+
+def project(doc, projection):
+    doc = {key: copy.deepcopy(value) for key, value in doc.items() if key != "_id"}
+    included = [key for key, value in (projection or {}).items() if value and key != "_id"]
+    if included:
+        return {key: doc[key] for key in included if key in doc}
+    return {key: value for key, value in doc.items() if (projection or {}).get(key, 1)}
+
+
+class FakeCollection:
+    """In-memory stand-in for a Motor collection; every call is atomic, like a single Mongo write"""
+
+    def __init__(self):
+        self.docs = []
+
+    def _matching(self, query, sort=None):
+        found = [doc for doc in self.docs if matches(doc, query)]
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return found
+
+    async def insert_one(self, doc):
+        self.docs.append(copy.deepcopy(doc))
+
+    async def find_one(self, query, projection=None, sort=None):
+        found = self._matching(query, sort)
+        return project(found[0], projection) if found else None
+
+    async def find_one_and_update(self, query, update, projection=None, sort=None,
+                                  return_document=ReturnDocument.BEFORE):
+        found = self._matching(query, sort)
+        if not found:
+            return None
+        before = project(found[0], projection)
+        apply_update(found[0], update)
+        return project(found[0], projection) if return_document == ReturnDocument.AFTER else before
+
+    async def update_one(self, query, update):
+        found = self._matching(query)[:1]
+        for doc in found:
+            apply_update(doc, update)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found))
+
+    async def update_many(self, query, update):
+        found = self._matching(query)
+        for doc in found:
+            apply_update(doc, update)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found))
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """An empty in-memory database swapped in for server.db"""
+    import server
+
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    server.user_cache.clear()
+    return database
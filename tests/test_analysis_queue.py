@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+from server import build_menu_items, claim_analysis_job, process_analysis_job, requeue_expired_analysis_jobs
+
+
+def timestamp(seconds=0):
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+
+def queued_job(n, **fields):
+    return {
+        "id": f"job-{n}",
+        "user_id": "user-1",
+        "status": "pending",
+        "queued_at": f"2024-01-01T00:00:{n:02d}+00:00",
+        "items": [],
+        "updated_at": "2024-01-01T00:00:00+00:00",
+        **fields
+    }
+
+
+def raw_item(name, price=12.0):
+    return {"name": name, "current_price": price, "food_cost": 4.0}
+
+
+def analysis_result(*raw_items):
+    return {"page_results": [{"items": list(raw_items)}], "pages_analyzed": 1, **build_menu_items(list(raw_items))}
+
+
+def stored(fake_db, job_id):
+    return next(doc for doc in fake_db.menu_jobs.docs if doc["id"] == job_id)
+
+
+def test_each_queued_job_is_claimed_once_oldest_first(fake_db):
+    fake_db.menu_jobs.docs = [
+        queued_job(2), queued_job(0), queued_job(1),
+        queued_job(3, queued_at=None),
+        queued_job(4, status="analyzing", lease_owner="worker-x")
+    ]
+
+    async def claim_all():
+        return await asyncio.gather(*(claim_analysis_job(f"worker-{n}") for n in range(5)))
+
+    claimed = asyncio.run(claim_all())
+    assert [job["id"] if job else None for job in claimed] == ["job-0", "job-1", "job-2", None, None]
+    for n, job in enumerate(claimed[:3]):
+        assert job["status"] == "analyzing"
+        assert job["queued_at"] is None
+        assert job["lease_owner"] == f"worker-{n}"
+    assert stored(fake_db, "job-4")["lease_owner"] == "worker-x"
+
+
+def test_expired_lease_is_requeued_and_claimable(fake_db):
+    fake_db.menu_jobs.docs = [
+        queued_job(0, status="analyzing", queued_at=None, lease_owner="worker-a", lease_expires_at=timestamp(-60)),
+        queued_job(1, status="analyzing", queued_at=None, lease_owner="worker-b", lease_expires_at=timestamp(60))
+    ]
+
+    assert asyncio.run(requeue_expired_analysis_jobs()) == 1
+    expired = stored(fake_db, "job-0")
+    assert expired["status"] == "pending"
+    assert expired["queued_at"] is not None
+    assert expired["lease_owner"] is None
+    assert stored(fake_db, "job-1")["lease_owner"] == "worker-b"
+
+    claimed = asyncio.run(claim_analysis_job("worker-c"))
+    assert claimed["id"] == "job-0"
+    assert claimed["lease_owner"] == "worker-c"
+
+
+def test_completed_analysis_is_saved_and_lease_released(fake_db, monkeypatch):
+    fake_db.menu_jobs.docs = [queued_job(0)]
+    job = asyncio.run(claim_analysis_job("worker-a"))
+
+    async def run_menu_analysis(job):
+        return analysis_result(raw_item("Burger"), raw_item("Fries"))
+
+    monkeypatch.setattr(server, "run_menu_analysis", run_menu_analysis)
+    asyncio.run(process_analysis_job(job, "worker-a"))
+
+    saved = stored(fake_db, "job-0")
+    assert saved["status"] == "completed"
+    assert saved["lease_owner"] is None
+    assert [item["name"] for item in saved["items"]] == ["Burger", "Fries"]
+
+
+def test_edit_made_during_analysis_is_merged_not_overwritten(fake_db, monkeypatch):
+    fake_db.menu_jobs.docs = [queued_job(0)]
+    job = asyncio.run(claim_analysis_job("worker-a"))
+    approved = {**build_menu_items([raw_item("Burger")])["items"][0], "approved_price": 15.0}
+
+    async def run_menu_analysis(job):
+        # The owner approves a price while the worker is still extracting
+        await fake_db.menu_jobs.update_one(
+            {"id": job["id"]},
+            {"$set": {"items": [approved], "updated_at": timestamp()}}
+        )
+        return analysis_result(raw_item("Burger"), raw_item("Fries"))
+
+    monkeypatch.setattr(server, "run_menu_analysis", run_menu_analysis)
+    asyncio.run(process_analysis_job(job, "worker-a"))
+
+    saved = stored(fake_db, "job-0")
+    assert saved["status"] == "completed"
+    assert saved["items"][0] == approved
+    assert saved["items"][1]["name"] == "Fries"
+
+
+def test_worker_that_lost_its_lease_does_not_save(fake_db, monkeypatch):
+    fake_db.menu_jobs.docs = [queued_job(0)]
+    job = asyncio.run(claim_analysis_job("worker-a"))
+
+    async def run_menu_analysis(job):
+        # The lease expires mid-analysis and another worker takes the job
+        await fake_db.menu_jobs.update_one({"id": job["id"]}, {"$set": {"lease_expires_at": timestamp(-1)}})
+        await requeue_expired_analysis_jobs()
+        await claim_analysis_job("worker-b")
+        return analysis_result(raw_item("Burger"))
+
+    monkeypatch.setattr(server, "run_menu_analysis", run_menu_analysis)
+    asyncio.run(process_analysis_job(job, "worker-a"))
+
+    saved = stored(fake_db, "job-0")
+    assert saved["status"] == "analyzing"
+    assert saved["lease_owner"] == "worker-b"
+    assert saved["items"] == []
+
+
+def test_failed_analysis_returns_job_to_pending(fake_db, monkeypatch):
+    fake_db.menu_jobs.docs = [queued_job(0)]
+    job = asyncio.run(claim_analysis_job("worker-a"))
+
+    async def run_menu_analysis(job):
+        raise RuntimeError("model unavailable")
+
+    monkeypatch.setattr(server, "run_menu_analysis", run_menu_analysis)
+    asyncio.run(process_analysis_job(job, "worker-a"))
+
+    saved = stored(fake_db, "job-0")
+    assert saved["status"] == "pending"
+    assert saved["lease_owner"] is None
+    assert "model unavailable" in saved["analysis_error"]
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from server import decode_menu_cursor, encode_menu_cursor, etag_matches, get_menu, menu_etag, not_modified
+
+USER = {"id": "user-1"}
+ETAG = menu_etag([("job-1", "2024-01-01T00:00:00+00:00")], "menu")
+
+
+@pytest.mark.parametrize("if_none_match, expected", [
+    (None, False),
+    ("", False),
+    (ETAG, True),
+    (f"W/{ETAG}", True),
+    (f'"other", {ETAG}', True),
+    ("*", True),
+    ('"other"', False),
+])
+def test_etag_matches(if_none_match, expected):
+    assert etag_matches(if_none_match, ETAG) is expected
+
+
+def test_etag_changes_with_version_and_variant():
+    assert menu_etag([("job-1", "2024-01-02T00:00:00+00:00")], "menu") != ETAG
+    assert menu_etag([("job-1", "2024-01-01T00:00:00+00:00")], "export:csv:False") != ETAG
+    assert menu_etag([("job-1", "2024-01-01T00:00:00+00:00")], "menu") == ETAG
+
+
+def test_not_modified_response():
+    response = not_modified(ETAG)
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["etag"] == ETAG
+    assert response.headers["cache-control"] == "private, no-cache"
+
+
+def test_get_menu_revalidation(fake_db):
+    fake_db.menu_jobs.docs = [{
+        "id": "job-1", "user_id": "user-1", "name": "Dinner",
+        "updated_at": "2024-01-01T00:00:00+00:00", "page_results": [{"items": []}]
+    }]
+
+    full = asyncio.run(get_menu("job-1", if_none_match=None, user=USER))
+    assert full.status_code == 200
+    assert full.headers["etag"] == ETAG
+    assert b"page_results" not in full.body
+
+    assert asyncio.run(get_menu("job-1", if_none_match=ETAG, user=USER)).status_code == 304
+
+    # An edit changes updated_at, so the client's copy is stale
+    fake_db.menu_jobs.docs[0]["updated_at"] = "2024-01-02T00:00:00+00:00"
+    changed = asyncio.run(get_menu("job-1", if_none_match=ETAG, user=USER))
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != ETAG
+
+
+def test_get_menu_revalidation_checks_ownership(fake_db):
+    fake_db.menu_jobs.docs = [{"id": "job-1", "user_id": "someone-else", "updated_at": "2024-01-01T00:00:00+00:00"}]
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(get_menu("job-1", if_none_match=ETAG, user=USER))
+    assert error.value.status_code == 404
+
+
+def test_menu_cursor_round_trip():
+    job = {"id": "job-1", "created_at": "2024-01-01T00:00:00+00:00"}
+    cursor = encode_menu_cursor(job)
+    assert "=" not in cursor
+    assert decode_menu_cursor(cursor) == (job["created_at"], job["id"])
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", "bm90IGpzb24", "WzFd"])
+def test_invalid_menu_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_menu_cursor(cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import refund_credit, reserve_credit, upload_menu
+
+USER = {"id": "user-1", "email": "owner@example.com", "location": "Austin"}
+
+
+@pytest.fixture
+def users(fake_db):
+    fake_db.users.docs = [{**USER, "credits": 2}]
+    return fake_db.users
+
+
+def balance(fake_db):
+    return fake_db.users.docs[0]["credits"]
+
+
+def ledger(fake_db):
+    return [(entry["delta"], entry["reason"], entry["balance_after"]) for entry in fake_db.credit_ledger.docs]
+
+
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+        self.headers = {"content-type": "multipart/form-data; boundary=b", "content-length": str(len(body))}
+
+    async def stream(self):
+        yield self.body
+
+
+def upload_body(filename, data):
+    return (
+        f'--b\r\nContent-Disposition: form-data; name="files"; filename="{filename}"\r\n\r\n'.encode()
+        + data + b"\r\n--b--\r\n"
+    )
+
+
+def test_reserve_debits_and_records(fake_db, users):
+    assert asyncio.run(reserve_credit("user-1", "menu_upload", "job-1")) == 1
+    assert balance(fake_db) == 1
+    assert ledger(fake_db) == [(-1, "menu_upload", 1)]
+
+
+def test_reserve_without_credits_is_refused(fake_db, users):
+    users.docs[0]["credits"] = 0
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(reserve_credit("user-1", "menu_upload", "job-1"))
+    assert error.value.status_code == 402
+    assert balance(fake_db) == 0
+    assert ledger(fake_db) == []
+
+
+def test_reserve_puts_the_credit_back_when_the_ledger_write_fails(fake_db, users, monkeypatch):
+    async def record_credit_change(*args):
+        raise RuntimeError("ledger unavailable")
+
+    monkeypatch.setattr(server, "record_credit_change", record_credit_change)
+    with pytest.raises(RuntimeError):
+        asyncio.run(reserve_credit("user-1", "menu_upload", "job-1"))
+    assert balance(fake_db) == 2
+
+
+def test_refund_returns_the_credit(fake_db, users):
+    asyncio.run(reserve_credit("user-1", "menu_upload", "job-1"))
+    asyncio.run(refund_credit("user-1", "menu_upload", "job-1"))
+    assert balance(fake_db) == 2
+    assert ledger(fake_db) == [(-1, "menu_upload", 1), (1, "refund:menu_upload", 2)]
+
+
+def test_failed_refund_is_logged_not_raised(fake_db, users, monkeypatch):
+    async def find_one_and_update(*args, **kwargs):
+        raise RuntimeError("primary stepped down")
+
+    monkeypatch.setattr(users, "find_one_and_update", find_one_and_update)
+    asyncio.run(refund_credit("user-1", "menu_upload", "job-1"))
+    assert balance(fake_db) == 2
+
+
+def test_failed_upload_refunds_its_credit(fake_db, users, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path)
+    request = FakeRequest(upload_body("menu.pdf", b"not a pdf" * 10))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(upload_menu(request, user=USER))
+    assert error.value.status_code == 400
+    assert balance(fake_db) == 2
+    assert [delta for delta, _, _ in ledger(fake_db)] == [-1, 1]
+    assert fake_db.menu_jobs.docs == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_successful_upload_keeps_its_credit(fake_db, users, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path)
+    request = FakeRequest(upload_body("menu.pdf", b"%PDF-1.4\n" + b"0" * 100))
+    response = asyncio.run(upload_menu(request, user=USER))
+    assert balance(fake_db) == 1
+    assert [job["id"] for job in fake_db.menu_jobs.docs] == [response["job_id"]]
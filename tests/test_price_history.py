@@ -0,0 +1,167 @@
+import asyncio
+
+import server
+from server import SNAPSHOT_ENCODING_FIELDS, encode_snapshot, expand_snapshots, replay_snapshot_chains
+
+
+def item(name, price):
+    return {"name": name, "approved_price": price, "food_cost": 3.0, "profit": round(price - 3.0, 2)}
+
+
+def snapshot(n, items, menu_id="menu-1"):
+    return {
+        "id": f"snapshot-{n}",
+        "menu_id": menu_id,
+        "user_id": "user-1",
+        "snapshot_date": f"2024-01-01T00:00:{n:02d}+00:00",
+        "total_items": len(items),
+        "items": items
+    }
+
+
+def state(doc, items):
+    """What latest_snapshot_state returns for a stored doc"""
+    return {"id": doc["id"], "keyframe_id": doc["keyframe_id"], "chain_length": doc["chain_length"], "items": items}
+
+
+def encode_history(*item_lists):
+    docs, previous = [], None
+    for n, items in enumerate(item_lists):
+        doc = encode_snapshot(snapshot(n, items), previous)
+        docs.append(doc)
+        previous = state(doc, items)
+    return docs
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return list(self.docs)
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return FakeCursor(
+            doc for doc in self.docs
+            if doc["user_id"] == query["user_id"] and doc.get("keyframe_id") in query["keyframe_id"]["$in"]
+        )
+
+
+class FakeReader:
+    def __init__(self, docs):
+        self.price_history = FakeCollection(docs)
+
+
+def test_first_snapshot_is_a_keyframe():
+    doc = encode_snapshot(snapshot(0, [item("A", 10.0)]), None)
+    assert doc["encoding"] == "keyframe"
+    assert doc["keyframe_id"] == doc["id"]
+    assert doc["chain_length"] == 0
+    assert doc["items"] == [item("A", 10.0)]
+
+
+def test_delta_stores_only_changes():
+    docs = encode_history([item("A", 10.0), item("B", 12.0)], [item("A", 10.0), item("B", 13.0)])
+    delta = docs[1]
+    assert delta["encoding"] == "delta"
+    assert delta["base_id"] == docs[0]["id"]
+    assert delta["keyframe_id"] == docs[0]["id"]
+    assert delta["chain_length"] == 1
+    assert delta["changed_items"] == [item("B", 13.0)]
+    assert delta["removed_items"] == []
+    assert "items" not in delta
+
+
+def test_removed_items():
+    docs = encode_history(
+        [item("A", 10.0), item("B", 12.0), item("C", 8.0)],
+        [item("A", 10.0), item("C", 8.0)],
+        [item("C", 9.0)]
+    )
+    assert docs[1]["removed_items"] == ["B"]
+    assert docs[2]["removed_items"] == ["A"]
+    states = replay_snapshot_chains(docs)
+    assert states["snapshot-1"] == [item("A", 10.0), item("C", 8.0)]
+    assert states["snapshot-2"] == [item("C", 9.0)]
+
+
+def test_duplicate_names_force_a_keyframe():
+    items = [item("A", 10.0), item("A", 11.0), item("B", 12.0)]
+    docs = encode_history([item("A", 10.0), item("B", 12.0)], items)
+    assert docs[1]["encoding"] == "keyframe"
+    assert replay_snapshot_chains(docs)["snapshot-1"] == items
+
+
+def test_delta_after_duplicate_name_keyframe_diffs_by_name():
+    docs = encode_history(
+        [item("A", 10.0), item("A", 11.0)],
+        [item("A", 11.0), item("B", 5.0)]
+    )
+    assert docs[0]["encoding"] == "keyframe"
+    assert docs[1]["encoding"] == "delta"
+    assert replay_snapshot_chains(docs)["snapshot-1"] == [item("A", 11.0), item("B", 5.0)]
+
+
+def test_legacy_predecessor_starts_a_new_chain():
+    doc = encode_snapshot(snapshot(1, [item("A", 10.0)]), {"id": "legacy-0", "legacy": True})
+    assert doc["encoding"] == "keyframe"
+    assert doc["keyframe_id"] == doc["id"]
+    # Legacy docs have no encoding field and replay as full snapshots
+    legacy = {**snapshot(0, [item("A", 9.0)]), "id": "legacy-0"}
+    assert replay_snapshot_chains([legacy, doc]) == {"legacy-0": [item("A", 9.0)], doc["id"]: [item("A", 10.0)]}
+
+
+def test_keyframe_interval(monkeypatch):
+    monkeypatch.setattr(server, "PRICE_HISTORY_KEYFRAME_INTERVAL", 3)
+    docs = encode_history(*([item("A", 10.0 + n)] for n in range(7)))
+    assert [doc["encoding"] for doc in docs] == ["keyframe", "delta", "delta"] * 2 + ["keyframe"]
+    states = replay_snapshot_chains(docs)
+    assert [states[doc["id"]] for doc in docs] == [[item("A", 10.0 + n)] for n in range(7)]
+
+
+def test_concurrent_deltas_sharing_a_base():
+    base = encode_snapshot(snapshot(0, [item("A", 10.0), item("B", 12.0)]), None)
+    previous = state(base, [item("A", 10.0), item("B", 12.0)])
+    # Two approvals raced and both encoded against the same latest snapshot
+    first = encode_snapshot(snapshot(1, [item("A", 11.0), item("B", 12.0)]), previous)
+    second = encode_snapshot(snapshot(2, [item("A", 10.0), item("B", 14.0)]), previous)
+    assert first["base_id"] == second["base_id"] == base["id"]
+    assert first["chain_length"] == second["chain_length"] == 1
+    states = replay_snapshot_chains([base, first, second])
+    assert states[first["id"]] == [item("A", 11.0), item("B", 12.0)]
+    assert states[second["id"]] == [item("A", 10.0), item("B", 14.0)]
+
+
+def test_expand_snapshots_fetches_missing_chain():
+    history = encode_history(
+        [item("A", 10.0), item("B", 12.0)],
+        [item("A", 11.0), item("B", 12.0)],
+        [item("A", 11.0)]
+    )
+    other_menu = encode_snapshot(snapshot(9, [item("Z", 1.0)], menu_id="menu-2"), None)
+    reader = FakeReader(history + [other_menu])
+
+    expanded = asyncio.run(expand_snapshots(reader, "user-1", [history[2]]))
+
+    assert reader.price_history.queries == [{"user_id": "user-1", "keyframe_id": {"$in": [history[0]["id"]]}}]
+    assert len(expanded) == 1
+    assert expanded[0]["id"] == history[2]["id"]
+    assert expanded[0]["items"] == [item("A", 11.0)]
+    assert not set(SNAPSHOT_ENCODING_FIELDS) & set(expanded[0])
+
+
+def test_expand_snapshots_uses_loaded_chain():
+    history = encode_history([item("A", 10.0)], [item("A", 11.0)])
+    reader = FakeReader([])
+
+    expanded = asyncio.run(expand_snapshots(reader, "user-1", history))
+
+    assert reader.price_history.queries == []
+    assert [doc["items"] for doc in expanded] == [[item("A", 10.0)], [item("A", 11.0)]]
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import format_bytes, receive_uploads
+
+BOUNDARY = "test-boundary"
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 120
+
+
+class FakeRequest:
+    """Just enough of a Starlette request for receive_uploads"""
+
+    def __init__(self, body, content_type=f"multipart/form-data; boundary={BOUNDARY}", content_length=True, chunk_size=64):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.headers = {"content-type": content_type}
+        if content_length:
+            self.headers["content-length"] = str(len(body))
+
+    async def stream(self):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+
+def multipart(*parts):
+    """Body for (field, filename or None, bytes) parts"""
+    body = b""
+    for field, filename, data in parts:
+        disposition = f'form-data; name="{field}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n\r\n".encode() + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "UPLOAD_DIR", tmp_path)
+    return tmp_path
+
+
+def receive(request, max_files=None):
+    return asyncio.run(receive_uploads(request, "files", max_files=max_files))
+
+
+def rejected(request, max_files=None):
+    with pytest.raises(HTTPException) as error:
+        receive(request, max_files)
+    return error.value
+
+
+def test_file_and_fields_are_saved(upload_dir):
+    uploads, fields = receive(FakeRequest(multipart(("name", None, b"Dinner"), ("files", "menu.png", PNG))))
+    assert fields == {"name": "Dinner"}
+    assert len(uploads) == 1
+    assert uploads[0]["filename"] == "menu.png"
+    assert uploads[0]["size"] == len(PNG)
+    assert uploads[0]["sha256"] == hashlib.sha256(PNG).hexdigest()
+    saved = Path(uploads[0]["path"])
+    assert saved.parent == upload_dir
+    assert saved.read_bytes() == PNG
+
+
+def test_non_multipart_body_is_rejected():
+    error = rejected(FakeRequest(b"{}", content_type="application/json"))
+    assert error.status_code == 400
+
+
+@pytest.mark.parametrize("filename, data", [
+    ("menu.gif", PNG),  # unsupported extension
+    ("menu.pdf", PNG),  # signature doesn't match the extension
+    ("menu.png", PNG[:3]),  # too small to be a real image
+    ("menu.png", b""),
+])
+def test_invalid_files_are_rejected(upload_dir, filename, data):
+    error = rejected(FakeRequest(multipart(("files", filename, data))))
+    assert error.status_code == 400
+    assert list(upload_dir.iterdir()) == []
+
+
+def test_file_over_the_limit_is_rejected_and_removed(upload_dir, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_FILE_BYTES", 100)
+    error = rejected(FakeRequest(multipart(("files", "menu.png", PNG))))
+    assert error.status_code == 413
+    assert "100 bytes" in error.detail
+    assert list(upload_dir.iterdir()) == []
+
+
+def test_declared_length_over_the_request_limit_is_rejected(monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_REQUEST_BYTES", 512 * 1024)
+    request = FakeRequest(b"")
+    request.headers["content-length"] = str(1024 * 1024)
+    error = rejected(request)
+    assert error.status_code == 413
+    assert "512 KB" in error.detail
+
+
+def test_chunked_body_over_the_request_limit_is_rejected(upload_dir, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_REQUEST_BYTES", 200)
+    body = multipart(("files", "a.png", PNG), ("files", "b.png", PNG))
+    error = rejected(FakeRequest(body, content_length=False))
+    assert error.status_code == 413
+    assert list(upload_dir.iterdir()) == []
+
+
+def test_extra_files_are_rejected_and_earlier_ones_removed(upload_dir):
+    error = rejected(FakeRequest(multipart(("files", "a.png", PNG), ("files", "b.png", PNG))), max_files=1)
+    assert error.status_code == 400
+    assert list(upload_dir.iterdir()) == []
+
+
+def test_truncated_body_is_rejected(upload_dir):
+    body = multipart(("files", "menu.png", PNG))
+    error = rejected(FakeRequest(body[:-10]))
+    assert error.status_code == 400
+    assert list(upload_dir.iterdir()) == []
+
+
+@pytest.mark.parametrize("size, text", [
+    (25 * 1024 * 1024, "25 MB"),
+    (1536 * 1024, "1.5 MB"),
+    (512 * 1024, "512 KB"),
+    (100, "100 bytes"),
+])
+def test_format_bytes(size, text):
+    assert format_bytes(size) == text
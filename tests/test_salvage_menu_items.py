@@ -0,0 +1,90 @@
+import json
+
+from server import build_menu_items, salvage_menu_items
+
+
+def item(name, price=10.0):
+    return {"name": name, "current_price": price, "ingredients": [], "food_cost": 3.0}
+
+
+def test_complete_response():
+    text = json.dumps({"items": [item("Burger"), item("Fries")]})
+    assert salvage_menu_items(text) == ([item("Burger"), item("Fries")], True)
+
+
+def test_fenced_response():
+    text = "```json\n" + json.dumps({"items": [item("Burger")]}, indent=2) + "\n```"
+    assert salvage_menu_items(text) == ([item("Burger")], True)
+
+
+def test_truncated_response_keeps_whole_items():
+    text = json.dumps({"items": [item("Burger"), item("Fries"), item("Shake")]})
+    truncated = text[:text.index('"Shake"') + 4]
+    assert salvage_menu_items(truncated) == ([item("Burger"), item("Fries")], False)
+
+
+def test_truncated_after_separator():
+    text = '{"items": [' + json.dumps(item("Burger")) + ",  "
+    assert salvage_menu_items(text) == ([item("Burger")], False)
+
+
+def test_missing_comma_is_not_complete():
+    text = '{"items":[{"name":"A"} {"name":"B"}]}'
+    assert salvage_menu_items(text) == ([{"name": "A"}], False)
+
+
+def test_trailing_comma_is_not_complete():
+    text = '{"items":[{"name":"A"},]}'
+    assert salvage_menu_items(text) == ([{"name": "A"}], False)
+
+
+def test_trailing_text_after_array():
+    text = '{"items": [{"name": "A"}, {"name": "B"}]} Let me know if you need anything else.'
+    assert salvage_menu_items(text) == ([{"name": "A"}, {"name": "B"}], True)
+
+
+def test_non_item_values_are_dropped():
+    values = [item("Burger"), "Fries", 4, None, {"price": 2}, {"name": "   "}, {"name": 7}, item("Shake")]
+    assert salvage_menu_items(json.dumps({"items": values})) == ([item("Burger"), item("Shake")], True)
+    assert salvage_menu_items(json.dumps({"items": values})[:-1]) == ([item("Burger"), item("Shake")], True)
+
+
+def test_empty_items():
+    assert salvage_menu_items('{"items": []}') == ([], True)
+    assert salvage_menu_items('{"items": [ ]') == ([], True)
+
+
+def test_no_items_array():
+    assert salvage_menu_items("Sorry, I can't read this menu.") == ([], False)
+    assert salvage_menu_items('{"menu": []}') == ([], False)
+
+
+def test_items_with_bad_prices_are_dropped():
+    values = [
+        item("Burger"),
+        {"name": "Soup", "current_price": None, "food_cost": 2.0},
+        {"name": "Salad", "current_price": "market price", "food_cost": 2.0},
+        {"name": "Pie", "current_price": 6.0, "food_cost": [1]},
+        {"name": "Tea", "current_price": True},
+        {"name": "Cake", "current_price": "NaN"},
+        {"name": "Water"},
+        {"name": "Coffee", "current_price": "3.50", "food_cost": 0.5}
+    ]
+    items, complete = salvage_menu_items(json.dumps({"items": values}))
+    assert complete
+    assert [i["name"] for i in items] == ["Burger", "Soup", "Water", "Coffee"]
+
+
+def test_build_menu_items_coerces_prices():
+    result = build_menu_items([
+        {"name": "Soup", "current_price": None, "food_cost": "1.5"},
+        {"name": "Coffee", "current_price": "3.50"}
+    ])
+    soup, coffee = result["items"]
+    assert (soup["current_price"], soup["food_cost"], soup["suggested_price"]) == (0.0, 1.5, 5.0)
+    assert (coffee["current_price"], coffee["food_cost"], coffee["profit_per_plate"]) == (3.5, 0.0, 3.5)
+
+
+def test_build_menu_items_skips_invalid_cached_items():
+    result = build_menu_items([{"name": "Salad", "current_price": "market price"}, item("Burger")])
+    assert [i["name"] for i in result["items"]] == ["Burger"]